@@ -4,6 +4,9 @@ PROJECT_NAME=EE-LLM
 
 export OMP_NUM_THREADS=8
 export CUDA_DEVICE_MAX_CONNECTIONS=1
+# Let the caching allocator grow segments in place instead of carving
+# new blocks for every distinct activation shape during generation.
+export PYTORCH_CUDA_ALLOC_CONF=expandable_segments:True
 
 # Tokenizer
 TOKENIZER_PATH=/home/xutingl/ee/EE-LLM/models/EE-LLM-1B-dj-refine-300B/tokenizer.model
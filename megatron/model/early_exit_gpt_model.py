@@ -1,5 +1,7 @@
 """Early-exit GPT model."""
 
+import logging
+
 import torch
 import torch.nn.functional as F
 
@@ -13,6 +15,9 @@ from .language_model import parallel_lm_logits
 from .language_model import get_language_model
 
 
+logger = logging.getLogger(__name__)
+
+
 def post_language_model_processing(lm_output, labels, logit_weights,
                                    parallel_output,
                                    fp16_lm_cross_entropy,
@@ -180,7 +185,7 @@ class EarlyExitGPTModel(MegatronModule):
                 inference_params=inference_params)
 
         if inference_params is not None and inference_params.has_early_exited:
-            print(f"[EarlyExitGPYModel: forward] returning early_exit_ids: {early_exit_ids}")
+            logger.debug("[EarlyExitGPYModel: forward] returning early_exit_ids: %s", early_exit_ids)
             return lm_output, early_exit_ids
         elif self.post_process:
             lm_output = post_language_model_processing(
@@ -188,12 +193,13 @@ class EarlyExitGPTModel(MegatronModule):
                 self.output_weight,
                 self.parallel_output,
                 self.fp16_lm_cross_entropy)
-            print(f"[EarlyExitGPYModel: forward] doing post process!!!")
+            logger.debug("[EarlyExitGPYModel: forward] doing post process")
         if self.has_early_exit and inference_params is None:
-            print(f"[EarlyExitGPYModel: forward] returning 1 !!!")
+            logger.debug("[EarlyExitGPYModel: forward] returning lm_output and early_exit_output")
             return lm_output, early_exit_output
         else:
-            print(f"[EarlyExitGPYModel: forward] returning 2 !!!, early_exit_ids: {early_exit_ids}, inference_params.has_early_exited: {inference_params.has_early_exited}, lm_output size: {lm_output.size()}")
+            logger.debug("[EarlyExitGPYModel: forward] returning lm_output and early_exit_ids: %s, has_early_exited: %s, lm_output size: %s",
+                         early_exit_ids, getattr(inference_params, 'has_early_exited', None), lm_output.size())
             return lm_output, early_exit_ids
 
     def state_dict_for_save_checkpoint(self, prefix='', keep_vars=False):
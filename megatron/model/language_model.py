@@ -2,6 +2,8 @@
 
 """Transformer based language model."""
 
+import logging
+
 import torch
 import torch.nn.functional as F
 
@@ -17,6 +19,9 @@ from .utils import get_linear_layer
 from .utils import init_method_normal, scaled_init_method_normal
 
 
+logger = logging.getLogger(__name__)
+
+
 def parallel_lm_logits(input_, word_embeddings_weight, parallel_output,
                        bias=None):
     """LM logits using word embedding weights."""
@@ -711,7 +716,7 @@ class EarlyExitTransformerLanguageModel(TransformerLanguageModel):
                 rotary_pos_emb = self.rotary_pos_emb(self.seq_length)
 
         # Run encoder.
-        print(f"[EarlyExitTransformerLanguageModel: forward] processing req_ids: {req_ids}")
+        logger.debug("[EarlyExitTransformerLanguageModel: forward] processing req_ids: %s", req_ids)
         encoder_output, early_exit_output, early_exit_ids = self.encoder(
             encoder_input,
             enc_attn_mask,
@@ -723,9 +728,11 @@ class EarlyExitTransformerLanguageModel(TransformerLanguageModel):
             exit_loss_func=exit_loss_func,
             req_ids=req_ids,)
         
-        print(f"[EarlyExitTransformerLanguageModel: forward] Returning early_exit_ids: {early_exit_ids}, encoder_output size: {encoder_output.size()}, early_exit_output {early_exit_output}")
+        logger.debug("[EarlyExitTransformerLanguageModel: forward] Returning early_exit_ids: %s, encoder_output size: %s, early_exit_output %s",
+                     early_exit_ids, encoder_output.size(), early_exit_output)
         if len(early_exit_ids) != encoder_output.size(1):
-            print(f"[EarlyExitTransformerLanguageModel: forward] !!!!!!!!Error!!!!!! length of early exit ids {len(early_exit_ids)} != encoder_output size(1): {encoder_output.size(1)}")
+            logger.warning("[EarlyExitTransformerLanguageModel: forward] length of early exit ids %d != encoder_output size(1): %d",
+                           len(early_exit_ids), encoder_output.size(1))
             
         return encoder_output, early_exit_output, early_exit_ids
 
@@ -2,6 +2,7 @@
 
 """Transformer."""
 from contextlib import nullcontext
+import logging
 import math
 import numpy as np
 import torch
@@ -36,6 +37,8 @@ except ImportError:
     except ImportError:
         flash_attn_unpadded_func = None
 
+logger = logging.getLogger(__name__)
+
 """ We use the following notation throughout this file:
      h: hidden size
      n: number of attention heads
@@ -1499,7 +1502,7 @@ class EarlyExitTransformerLayer(MegatronModule):
                 exit_loss_func=None,
                 return_exited_mask=False):
         if self.pre_exit:
-            print(f"Pre exit; Hidden states size: {hidden_states.size()}")
+            logger.debug("Pre exit; Hidden states size: %s", hidden_states.size())
             exit_output, exit = self._forward_exit(hidden_states=hidden_states,
                                                    inference_params=inference_params,
                                                    exit_process_func=exit_process_func,
@@ -1517,7 +1520,7 @@ class EarlyExitTransformerLayer(MegatronModule):
         else:
             exit_hidden_states = hidden_states
         if not self.pre_exit:
-            print(f"Not pre exit; Hidden states size: {hidden_states.size()}")
+            logger.debug("Not pre exit; Hidden states size: %s", hidden_states.size())
             if return_exited_mask:
                 exit_output, exit, exited_mask = self._forward_exit(hidden_states=exit_hidden_states,
                                                     inference_params=inference_params,
@@ -1536,7 +1539,8 @@ class EarlyExitTransformerLayer(MegatronModule):
                                                        return_exited_mask=False)
         
         if return_exited_mask:
-            print(f"[EarlyExitTransformerLayer: forward] Returning hidden_states size: {hidden_states.size()}, exit_output size: {exit_output.size()}, exit: {exit}, exited_mask: {exited_mask}")
+            logger.debug("[EarlyExitTransformerLayer: forward] Returning hidden_states size: %s, exit_output size: %s, exit: %s, exited_mask: %s",
+                         hidden_states.size(), exit_output.size(), exit, exited_mask)
             return hidden_states, exit_output, exit, exited_mask
         return hidden_states, exit_output, exit
 
@@ -2088,17 +2092,15 @@ class HiddenStatesBuffer():
         self.hidden_states_map = dict() # keys: req_ids, values: indices in hidden_states.
     
     def add_hidden_states(self, hidden_states: torch.Tensor, req_ids: List[int]):
-        print(f"adding hidden states. size: {hidden_states.size()}, req_ids: {req_ids}")
-        print(f"[add_hidden_states] hidden_states size: {hidden_states.size()}")
+        logger.debug("[add_hidden_states] hidden_states size: %s, req_ids: %s", hidden_states.size(), req_ids)
         num_hidden_states = hidden_states.size(0)
         assert num_hidden_states + len(self.hidden_states_map) <= self.capacity, f"Not enough capacity in hidden states buffer. num_hidden_states: {num_hidden_states}, len(hidden_states_map): {len(self.hidden_states_map)}, capacity: {self.capacity}"
         assert self.hidden_states.size(1) == hidden_states.size(1), f"Hidden states have different lengths, buffer requires size {self.hidden_states.size(1)} but got {hidden_states.size(1)}"
 
         # Find available slots in hidden_states and put hidden states in them
-        for i in range(num_hidden_states):
-            slot = self.available_slots.pop()
-            self.hidden_states[slot] = hidden_states[i]
-            self.hidden_states_map[req_ids[i]] = slot
+        slots = [self.available_slots.pop() for _ in range(num_hidden_states)]
+        self.hidden_states[slots] = hidden_states.to(self.hidden_states.device)
+        self.hidden_states_map.update(zip(req_ids, slots))
     
     def take_hidden_states(self, num: int=0):
         if num == 0:
@@ -2242,14 +2244,14 @@ class EarlyExitParallelTransformer(ParallelTransformer):
                 # Check buffer_layer11 and buffer_layer5. If there are enough hidden states, put iput hidden states into layer0 buffer. Take hidden states from layer11 or layer 5 out, process them at corrresponding layer.
                 start_at_layer = 0
                 if len(self.buffer_layer11) >= self.batch_size:
-                    print(f"[EarlyExitParallelTransformer forward] adding hidden states to layer0 buffer to proceed at l11. size: {hidden_states[0].size()}")
+                    logger.debug("[EarlyExitParallelTransformer forward] adding hidden states to layer0 buffer to proceed at l11. size: %s", hidden_states[0].size())
                     self.buffer_layer0.add_hidden_states(hidden_states[0], req_ids)
                     hidden_states, req_ids = self.buffer_layer11.take_hidden_states()
                     hidden_states.unsqueeze_(0) # transform <batch_size, 2048> to <1, batch_size, 2048>
 
                     start_at_layer = 11
                 elif len(self.buffer_layer5) >= self.batch_size:
-                    print(f"[EarlyExitParallelTransformer forward] adding hidden states to layer0 buffer to proceed at l5. size: {hidden_states[0].size()}")
+                    logger.debug("[EarlyExitParallelTransformer forward] adding hidden states to layer0 buffer to proceed at l5. size: %s", hidden_states[0].size())
                     self.buffer_layer0.add_hidden_states(hidden_states[0], req_ids)
                     hidden_states, req_ids = self.buffer_layer5.take_hidden_states()
                     hidden_states.unsqueeze_(0)
@@ -2270,7 +2272,7 @@ class EarlyExitParallelTransformer(ParallelTransformer):
                                                                             return_exited_mask=True)
                         # When req_ids is not provided, exit is True iff the last req in the batch wants to EE
                         # When req_ids is provided, exit is True iff at least 1 req in the batch want to EE
-                        print(f"[EarlyExitParallelTransformer forward] exit: {exit}")
+                        logger.debug("[EarlyExitParallelTransformer forward] exit: %s", exit)
                         if len(req_ids) > 0:
                             exit = exit or any(exited_mask)
 
@@ -2279,38 +2281,43 @@ class EarlyExitParallelTransformer(ParallelTransformer):
                             lazy_early_exit_loss_funcs[layer.layer_number] = exit_output
                         elif exit:
                             # change output in inference mode
-                            print(f"[EarlyExitParallelTransformer forward] exited_mask: {exited_mask}")
-                            exited_idx = torch.tensor([i for i, val in enumerate(exited_mask) if val])
+                            logger.debug("[EarlyExitParallelTransformer forward] exited_mask: %s", exited_mask)
+                            # Split the batch positions once on the host, exited_mask is a list.
+                            exited_positions, remaining_positions = [], []
+                            for pos_idx, exited in enumerate(exited_mask):
+                                (exited_positions if exited else remaining_positions).append(pos_idx)
+                            exited_idx = torch.tensor(exited_positions, device=exit_output.device)
                             # We want to return request ids along with exit states in order to manage the buffer.
                             if len(req_ids) > 0:
                                 # All requests want to EE. Nothing goes into buffer
-                                if sum(exited_mask) == len(exited_mask):
+                                if len(remaining_positions) == 0:
                                     return exit_output, exit_output, req_ids
                                 # Requests that don't want to EE go into buffer. Return the hidden states of the request that EE, alogn with their ids
-                                exited_req_ids = [req_ids[i] for i in exited_idx]
+                                exited_req_ids = [req_ids[i] for i in exited_positions]
+                                remaining_req_ids = [req_ids[i] for i in remaining_positions]
+                                remaining_idx = torch.tensor(remaining_positions, device=hidden_states.device)
                                 if index == 5:
-                                    for pos_idx, exited in enumerate(exited_mask):
-                                        if not exited:
-                                            print(f"[EarlyExitParallelTransformer forward] adding hidden states to layer5 buffer. size: {hidden_states[0][pos_idx,:].unsqueeze(0).size()}, original hidden states size: {hidden_states.size()}")
-                                            self.buffer_layer5.add_hidden_states(hidden_states[0][pos_idx,:].unsqueeze(0), [req_ids[pos_idx]])
+                                    logger.debug("[EarlyExitParallelTransformer forward] adding hidden states to layer5 buffer. original hidden states size: %s", hidden_states.size())
+                                    self.buffer_layer5.add_hidden_states(hidden_states[0].index_select(0, remaining_idx), remaining_req_ids)
                                     
-                                    print(f"[EarlyExitParallelTransformer forward return 1] exited_idx: {exited_idx}, exited_req_ids: {exited_req_ids}, exit_output size: {exit_output.size()}, size after slicing: {exit_output[exited_idx,:,:].size()}")
+                                    logger.debug("[EarlyExitParallelTransformer forward return 1] exited_idx: %s, exited_req_ids: %s, exit_output size: %s",
+                                                 exited_idx, exited_req_ids, exit_output.size())
                                     return exit_output[exited_idx,:,:], exit_output[exited_idx,:,:], exited_req_ids
                                     return exit_output, exit_output, req_ids
                                 elif index == 11:
-                                    for pos_idx, exited in enumerate(exited_mask):
-                                        if not exited:
-                                            print(f"[EarlyExitParallelTransformer forward] adding hidden states to layer11 buffer. size: {hidden_states[0][pos_idx,:].size()}")
-                                            self.buffer_layer11.add_hidden_states(hidden_states[0][pos_idx,:].unsqueeze(0), [req_ids[pos_idx]])
+                                    logger.debug("[EarlyExitParallelTransformer forward] adding hidden states to layer11 buffer. original hidden states size: %s", hidden_states.size())
+                                    self.buffer_layer11.add_hidden_states(hidden_states[0].index_select(0, remaining_idx), remaining_req_ids)
                                     
-                                    print(f"[EarlyExitParallelTransformer forward return 2] exited_idx: {exited_idx}, exited_req_ids: {exited_req_ids}, exit_output size: {exit_output.size()}, size after slicing: {exit_output[exited_idx,:,:].size()}")
+                                    logger.debug("[EarlyExitParallelTransformer forward return 2] exited_idx: %s, exited_req_ids: %s, exit_output size: %s",
+                                                 exited_idx, exited_req_ids, exit_output.size())
                                     return exit_output[exited_idx,:,:], exit_output[exited_idx,:,:], exited_req_ids
                                     return exit_output, exit_output, req_ids
                                 else:
                                     raise ValueError("Early exit layer not supported")
 
                             # If request ids are not provoded, we just return the output
-                            print(f"[EarlyExitParallelTransformer forward return 3] exited_idx: {exited_idx}, exited_req_ids: {exited_req_ids}, exit_output size: {exit_output.size()}, size after slicing: {exit_output[exited_idx,:,:].size()}")
+                            logger.debug("[EarlyExitParallelTransformer forward return 3] exited_idx: %s, exit_output size: %s",
+                                         exited_idx, exit_output.size())
                             return exit_output, exit_output, None
                         
                         # I think the following 2 lines are redundant
@@ -2394,7 +2401,7 @@ class EarlyExitParallelTransformer(ParallelTransformer):
                             lazy_early_exit_loss_funcs[layer.layer_number] = exit_output
                         elif exit:
                             # change output in inference mode
-                            print(f"ee mask (0: doesn't want to EE, 1: wants to EE): {exited_mask}")
+                            logger.debug("ee mask (0: doesn't want to EE, 1: wants to EE): %s", exited_mask)
                             return exit_output, exit_output
                         if exit:
                             break
@@ -183,8 +183,11 @@ def generate(model,
     if torch.distributed.get_rank() == 0:
         assert prompts is not None
 
-    context_tokens_tensor, context_length_tensor = tokenize_prompts(
-        prompts=prompts, tokens_to_generate=tokens_to_generate, add_BOS=add_BOS)
+    context_tokens_tensor, context_length_tensor, min_prompt_length = \
+        tokenize_prompts(prompts=prompts,
+                         tokens_to_generate=tokens_to_generate,
+                         add_BOS=add_BOS,
+                         return_min_prompt_length=True)
 
     if tokens_to_generate == 0:
         return score_and_return_on_first_stage(
@@ -203,13 +206,16 @@ def generate(model,
                 top_p_bound=top_p_bound,
                 temperature=temperature,
                 use_stop_tokens_for_early_termination=use_stop_tokens_for_early_termination,
+                stop_on_double_eol=stop_on_double_eol,
+                stop_on_eol=stop_on_eol,
                 stop_tokens=stop_token_ids,
                 prevent_newline_after_colon=prevent_newline_after_colon,
                 echo_prompts=echo_prompts,
                 early_exit_thres=early_exit_thres,
                 use_early_exit=use_early_exit,
                 print_max_prob=print_max_prob,
-                exit_layers=exit_layers)
+                exit_layers=exit_layers,
+                min_prompt_length=min_prompt_length)
         else:
             output = generate_tokens_probs_and_return_on_first_stage(
                 model, context_tokens_tensor, context_length_tensor,
@@ -220,6 +226,8 @@ def generate(model,
                 top_p_bound=top_p_bound,
                 temperature=temperature,
                 use_stop_tokens_for_early_termination=use_stop_tokens_for_early_termination,
+                stop_on_double_eol=stop_on_double_eol,
+                stop_on_eol=stop_on_eol,
                 stop_tokens=stop_token_ids,
                 prevent_newline_after_colon=prevent_newline_after_colon,
                 echo_prompts=echo_prompts,
@@ -228,7 +236,8 @@ def generate(model,
                 print_max_prob=print_max_prob,
                 exit_layers=exit_layers,
                 req_ids=req_ids,
-                buffered_tokens=buffered_tokens,)
+                buffered_tokens=buffered_tokens,
+                min_prompt_length=min_prompt_length,)
     except Exception as e:
         traceback.print_exc()
     return output
@@ -282,9 +291,11 @@ def beam_search(model, prompts=None, tokens_to_generate=0, beam_size=0, add_BOS=
     length_penalty = values_float_tensor[5].item()
     prevent_newline_after_colon = values_float_tensor[6].item()
 
-    context_tokens_tensor, context_length_tensor = tokenize_prompts(
-        prompts=prompts, tokens_to_generate=tokens_to_generate, add_BOS=add_BOS)
+    # Beam search runs a single prompt, its length is the minimum.
+    context_tokens_tensor, context_length_tensor, prompt_length = tokenize_prompts(
+        prompts=prompts, tokens_to_generate=tokens_to_generate, add_BOS=add_BOS,
+        return_min_prompt_length=True)
     
     return beam_search_and_return_on_first_stage(model, context_tokens_tensor, context_length_tensor, 
             beam_size, stop_token=stop_token, num_return_gen=num_return_gen, length_penalty=length_penalty,
-            prevent_newline_after_colon=prevent_newline_after_colon)
+            prevent_newline_after_colon=prevent_newline_after_colon, prompt_length=prompt_length)
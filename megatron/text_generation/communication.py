@@ -43,6 +43,10 @@ def send_to_next_pipeline_rank(tensor=None):
 
 
 def recv_list_from_prev_pipeline_rank(recv_buffers):
+    """Receive a list of tensors from the previous pipeline stage in
+    place. All receives are issued as one batch_isend_irecv call, which
+    coalesces them into a single NCCL group. Prefer packing small
+    tensors into one buffer (see forward_step) over using this."""
     if not mpu.is_pipeline_first_stage():
         assert recv_buffers is not None and type(recv_buffers) is list
         recv_prev_ops = [torch.distributed.P2POp(
@@ -56,6 +60,9 @@ def recv_list_from_prev_pipeline_rank(recv_buffers):
 
 
 def send_list_to_next_pipeline_rank(tensors):
+    """Send a list of tensors to the next pipeline stage. All sends are
+    issued as one batch_isend_irecv call, which coalesces them into a
+    single NCCL group."""
     if not mpu.is_pipeline_last_stage():
         assert tensors is not None and type(tensors) is list
         send_next_ops = [torch.distributed.P2POp(
@@ -199,59 +206,70 @@ def get_exit_stages():
 EXIT=1
 CONTINUE=0
 
+def _get_signal_buffer(inference_params):
+    """One element buffer for the exit signal, reused across steps."""
+    if inference_params.signal_buffer is None:
+        inference_params.signal_buffer = torch.empty(
+            1, dtype=torch.int8, device=torch.cuda.current_device())
+    return inference_params.signal_buffer
+
+
+def _get_payload_buffer(inference_params, batch_size):
+    """[2, b] buffer holding the tokens and their log probs, so both go
+    in a single message. float64 keeps token ids and float32 log probs
+    exact."""
+    if inference_params.payload_buffer is None or \
+       inference_params.payload_buffer.size(1) != batch_size:
+        inference_params.payload_buffer = torch.empty(
+            (2, batch_size), dtype=torch.float64,
+            device=torch.cuda.current_device())
+    return inference_params.payload_buffer
+
+
 def send_token_and_probs_to_first_pipeline_stage(inference_params, token_tensor=None, prob_tensor=None, is_final=False):
-    signal_tensor = torch.empty(1, dtype=torch.int8, device=torch.cuda.current_device())
+    signal_tensor = _get_signal_buffer(inference_params)
     if inference_params.has_early_exited or is_final:
-        signal_tensor[0] = EXIT
+        signal_tensor.fill_(EXIT)
         _is_cuda(token_tensor)
         _is_cuda(prob_tensor)
     else:
-        signal_tensor[0] = CONTINUE
+        signal_tensor.fill_(CONTINUE)
     dist.send(tensor=signal_tensor, dst=0, group=mpu.get_pipeline_model_parallel_group())
     if inference_params.has_early_exited or is_final:
-        dist.send(tensor=token_tensor, dst=0, group=mpu.get_pipeline_model_parallel_group())
-        dist.send(tensor=prob_tensor, dst=0, group=mpu.get_pipeline_model_parallel_group())
+        payload = _get_payload_buffer(inference_params, token_tensor.numel())
+        payload[0].copy_(token_tensor.view(-1))
+        payload[1].copy_(prob_tensor.view(-1))
+        dist.send(tensor=payload, dst=0, group=mpu.get_pipeline_model_parallel_group())
 
 
 def recv_token_and_probs(inference_params, token_tensor_buffer, prob_tensor_buffer):
 
-    is_contiguous = token_tensor_buffer.is_contiguous()
-    if is_contiguous:
-        token_tensor_ = token_tensor_buffer
-        prob_tensor_ = prob_tensor_buffer
-    else:
-        token_tensor_ = torch.empty(token_tensor_buffer.shape[0],
-                                dtype=torch.int64,
-                                device=torch.cuda.current_device())
-        prob_tensor_ = torch.empty(prob_tensor_buffer.shape[0],
-                                dtype=torch.float32,
-                                device=torch.cuda.current_device())
-
     # if first stage has early exit, get tensor directly
     if mpu.has_early_exit():
         if inference_params.has_early_exited:
             assert inference_params.tokens is not None
-            token_tensor_buffer[...] = inference_params.tokens
-            prob_tensor_buffer[...] = inference_params.probs
+            # probs is [b, 1], the buffers are [b].
+            token_tensor_buffer.copy_(inference_params.tokens.view(-1))
+            prob_tensor_buffer.copy_(inference_params.probs.view(-1))
             return
 
     exit_stages = get_exit_stages()
     if exit_stages[0] == 0:
         exit_stages.pop(0)
-    signal_tensor = torch.empty(1, dtype=torch.int8, device=torch.cuda.current_device())
+    signal_tensor = _get_signal_buffer(inference_params)
 
     # get tensor from subsequent stages one by one
     for stage_id in exit_stages:
         dist.recv(tensor=signal_tensor, src=stage_id, group=mpu.get_pipeline_model_parallel_group())
         if signal_tensor[0] == EXIT:
-            dist.recv(tensor=token_tensor_, src=stage_id, group=mpu.get_pipeline_model_parallel_group())
-            dist.recv(tensor=prob_tensor_, src=stage_id, group=mpu.get_pipeline_model_parallel_group())
+            payload = _get_payload_buffer(inference_params,
+                                          token_tensor_buffer.shape[0])
+            dist.recv(tensor=payload, src=stage_id, group=mpu.get_pipeline_model_parallel_group())
+            # copy_ casts back and handles non contiguous buffers.
+            token_tensor_buffer.copy_(payload[0])
+            prob_tensor_buffer.copy_(payload[1])
             break
 
-    if not is_contiguous:
-        token_tensor_buffer[...] = token_tensor_
-        prob_tensor_buffer[...] = prob_tensor_
-
 def broadcast_tensor(size, dtype, tensor=None, rank=0):
     """ Given size and type of a tensor on all ranks and the tensor value
         only on a specific rank, broadcast from that rank to all other ranks.
@@ -11,22 +11,28 @@ from megatron.core import mpu
 from .inference_params import InferenceParams
 from .communication import (
     send_to_next_pipeline_rank,
-    recv_from_prev_pipeline_rank_,
-    send_list_to_next_pipeline_rank,
-    recv_list_from_prev_pipeline_rank)
+    recv_from_prev_pipeline_rank_)
 
 
 class ForwardStep:
     """Forward step function with all the communications.
     We use a class here to hide the inference parameters
-    from the outside caller."""
+    from the outside caller.
+
+    The step is run eagerly and not replayed from a CUDA graph: the
+    KV cache is sliced with the host side sequence_len_offset, and the
+    early exit layers branch on their exit decision and send tokens to
+    the first stage in the middle of the forward pass, so the launched
+    work differs from one token to the next."""
 
     def __init__(self, model, max_batch_size=0, max_sequence_length=0, early_exit_thres=0, inference_params=None):
         """Set values so we don't need to do it multiple times."""
-        # Make sure model is in eval mode.
+        # Make sure model is in eval mode. eval() walks every submodule,
+        # so skip it when a previous ForwardStep already did it.
         assert not isinstance(model, Iterable), \
             'interleaving schedule is not supported for inference'
-        model.eval()
+        if model.training:
+            model.eval()
         self.model = model
         # Initialize inference parameters.
         if inference_params is None:
@@ -41,86 +47,165 @@ class ForwardStep:
         # Threshold of pipelining.
         self.pipelining_batch_x_seqlen = \
             args.inference_batch_times_seqlen_threshold
-
-
-    def __call__(self, tokens, position_ids, attention_mask, req_ids=[]):
+        # Stage layout and sizes, looked up once instead of every step.
+        self.is_first_stage = mpu.is_pipeline_first_stage()
+        self.is_last_stage = mpu.is_pipeline_last_stage()
+        self.hidden_size = args.hidden_size
+        self.fp32_residual_connection = args.fp32_residual_connection
+        self.device = torch.cuda.current_device()
+        # Preallocate the p2p buffers once so the forward steps
+        # only need to take views of them.
+        self.recv_buffer_storage = None
+        self.send_buffer_storage = None
+        if self.pipeline_size_larger_than_one:
+            if not self.is_first_stage:
+                self.recv_buffer_storage = _allocate_recv_buffer_storage(
+                    self.inference_params.max_batch_size,
+                    self.inference_params.max_sequence_length,
+                    device=self.device)
+            if not self.is_last_stage:
+                self.send_buffer_storage = _allocate_recv_buffer_storage(
+                    self.inference_params.max_batch_size,
+                    self.inference_params.max_sequence_length,
+                    device=self.device)
+
+
+    def __call__(self, tokens, position_ids, attention_mask, req_ids=None):
         """Invocation of the forward methods. Note that self.inference_params
-        is being modified by the forward step."""
+        is being modified by the forward step. req_ids of None means no
+        request tracking."""
         # Pipelining case.
         if self.pipeline_size_larger_than_one:
             return _with_early_exit_pipelining_forward_step(self.model,
                                                      tokens,
                                                      position_ids,
                                                      attention_mask,
-                                                     self.inference_params)
+                                                     self.inference_params,
+                                                     recv_buffer_storage=self.recv_buffer_storage,
+                                                     send_buffer_storage=self.send_buffer_storage,
+                                                     is_first_stage=self.is_first_stage,
+                                                     is_last_stage=self.is_last_stage,
+                                                     hidden_size=self.hidden_size,
+                                                     fp32_residual_connection=self.fp32_residual_connection,
+                                                     device=self.device)
 
         return _no_pipelining_forward_step(self.model,
                                            tokens,
                                            position_ids,
                                            attention_mask,
                                            self.inference_params,
-                                           req_ids=req_ids)
+                                           req_ids=req_ids,
+                                           is_first_stage=self.is_first_stage,
+                                           is_last_stage=self.is_last_stage)
 
 
 
 def _get_recv_buffer_dtype(args):
-    """Receive happens between the layers."""
-    if args.fp32_residual_connection:
-        return torch.float
+    """Receive happens between the layers. Activations always travel
+    in params_dtype, even with fp32_residual_connection, to halve the
+    p2p payload. The receiving stage upcasts them locally (see
+    _get_input_tensor) before its residual adds."""
     return args.params_dtype
 
 
 
-def _allocate_recv_buffer(batch_size, sequence_length):
+def _get_input_tensor(recv_buffer, fp32_residual_connection=None):
+    """Input tensor of this stage from the received activations."""
+    if recv_buffer is None:
+        return None
+    if fp32_residual_connection is None:
+        fp32_residual_connection = get_args().fp32_residual_connection
+    if fp32_residual_connection:
+        return recv_buffer.float()
+    return recv_buffer
+
+
+
+def _allocate_recv_buffer(batch_size, sequence_length, device=None):
     """Receive happens between the layers with size [s, b, h]."""
     if mpu.is_pipeline_first_stage():
         return None
     args = get_args()
     recv_size = (sequence_length, batch_size, args.hidden_size)
+    if device is None:
+        device = torch.cuda.current_device()
     return torch.empty(recv_size,
                        dtype=_get_recv_buffer_dtype(args),
-                       device=torch.cuda.current_device())
+                       device=device)
+
+
+
+def _allocate_recv_buffer_storage(max_batch_size, max_sequence_length,
+                                  device=None):
+    """Flat buffer large enough to hold any [s, b, h] receive with
+    s <= max_sequence_length and b <= max_batch_size, plus one trailing
+    element for the early exit signal."""
+    args = get_args()
+    numel = max_sequence_length * max_batch_size * args.hidden_size + 1
+    if device is None:
+        device = torch.cuda.current_device()
+    return torch.empty(numel,
+                       dtype=_get_recv_buffer_dtype(args),
+                       device=device)
 
 
 
 def _forward_step_helper(model, tokens, position_ids, attention_mask,
-                         inference_params, recv_buffer=None, req_ids=[]):
+                         inference_params, recv_buffer=None, req_ids=None,
+                         is_first_stage=None, is_last_stage=None):
     """Single forward step. Update the allocate memory flag so
-    only the first time the memory is allocated."""
-    batch_size = tokens.size(0)
-    sequence_length = tokens.size(1)
-    if recv_buffer is None:
-        recv_buffer = _allocate_recv_buffer(batch_size, sequence_length)
+    only the first time the memory is allocated. The stage flags are
+    looked up if the caller does not provide them."""
+    if is_first_stage is None:
+        is_first_stage = mpu.is_pipeline_first_stage()
+    if is_last_stage is None:
+        is_last_stage = mpu.is_pipeline_last_stage()
 
     # Receive from previous stage.
-    recv_from_prev_pipeline_rank_(recv_buffer)
+    if is_first_stage:
+        recv_buffer = None
+    else:
+        if recv_buffer is None:
+            recv_buffer = _allocate_recv_buffer(tokens.size(0),
+                                                tokens.size(1))
+        recv_from_prev_pipeline_rank_(recv_buffer)
 
     # Forward pass through the model.
-    model.set_input_tensor(recv_buffer)
-    output_tensor, early_exit_ids = model(tokens, position_ids, attention_mask,
-                          inference_params=inference_params, req_ids=req_ids)
+    model.set_input_tensor(_get_input_tensor(recv_buffer))
+    if req_ids is None:
+        output_tensor, early_exit_ids = model(tokens, position_ids, attention_mask,
+                                              inference_params=inference_params)
+    else:
+        output_tensor, early_exit_ids = model(tokens, position_ids, attention_mask,
+                                              inference_params=inference_params,
+                                              req_ids=req_ids)
 
     # Send output to the next stage.
-    send_to_next_pipeline_rank(output_tensor)
-
-    print(f"[ForwardStep: _forward_step_helper] returning output_tensor size: {output_tensor.size()}, early_exit_ids: {early_exit_ids}")
+    if not is_last_stage:
+        send_to_next_pipeline_rank(
+            output_tensor.to(_get_recv_buffer_dtype(get_args())))
 
     return output_tensor, early_exit_ids
 
 
 
 def _no_pipelining_forward_step(model, tokens, position_ids, attention_mask,
-                                inference_params, recv_buffer=None, req_ids=[]):
+                                inference_params, recv_buffer=None, req_ids=None,
+                                is_first_stage=None, is_last_stage=None):
     """If recv_buffer is none, we will allocate one on the fly."""
+    if is_last_stage is None:
+        is_last_stage = mpu.is_pipeline_last_stage()
     # Run a simple forward pass.
     output_tensor = _forward_step_helper(model, tokens, position_ids,
                                          attention_mask, inference_params,
-                                         recv_buffer=recv_buffer, req_ids=req_ids)
+                                         recv_buffer=recv_buffer, req_ids=req_ids,
+                                         is_first_stage=is_first_stage,
+                                         is_last_stage=is_last_stage)
     # Update the sequence length offset.
     # inference_params.sequence_len_offset += tokens.size(1)
 
     logits = None
-    if mpu.is_pipeline_last_stage():
+    if is_last_stage:
         logits = output_tensor
 
     return logits
@@ -128,8 +213,10 @@ def _no_pipelining_forward_step(model, tokens, position_ids, attention_mask,
 
 
 def _with_pipelining_forward_step(model, tokens, position_ids, attention_mask,
-                                  inference_params, micro_batch_size):
-    """No interleaving is supported."""
+                                  inference_params, micro_batch_size,
+                                  recv_buffer_storage=None):
+    """No interleaving is supported. If recv_buffer_storage is provided,
+    the receive buffers are views of it instead of new allocations."""
     sequence_length = tokens.size(1)
     batch_size = tokens.size(0)
 
@@ -139,16 +226,23 @@ def _with_pipelining_forward_step(model, tokens, position_ids, attention_mask,
     if last_chunk > 0:
         num_micro_batches += 1
 
+    is_first_stage = mpu.is_pipeline_first_stage()
+    is_last_stage = mpu.is_pipeline_last_stage()
+    device = torch.cuda.current_device()
+
     # Preallocate memory for output logits.
     logits = None
-    if mpu.is_pipeline_last_stage():
+    if is_last_stage:
         args = get_args()
         logits = torch.empty(
             (batch_size, sequence_length, args.padded_vocab_size),
-            dtype=torch.float32, device=torch.cuda.current_device())
+            dtype=torch.float32, device=device)
 
     # Preallocate recv buffer.
-    recv_buffer = _allocate_recv_buffer(micro_batch_size, sequence_length)
+    recv_buffer = None
+    if not is_first_stage:
+        recv_buffer = _recv_buffer_view(micro_batch_size, sequence_length,
+                                        recv_buffer_storage, device=device)
 
     for micro_batch_index in range(num_micro_batches):
         # Slice among the batch dimenion.
@@ -159,17 +253,23 @@ def _with_pipelining_forward_step(model, tokens, position_ids, attention_mask,
         position_ids2use = position_ids[start:end, ...]
 
         # Run a simple forward pass.
-        if this_micro_batch_size != micro_batch_size:
-            recv_buffer = None
-        output = _forward_step_helper(model, tokens2use, position_ids2use,
-                                      attention_mask, inference_params,
-                                      recv_buffer=recv_buffer)
+        if this_micro_batch_size != micro_batch_size and \
+           recv_buffer is not None:
+            recv_buffer = _recv_buffer_view(this_micro_batch_size,
+                                            sequence_length,
+                                            recv_buffer_storage,
+                                            device=device)
+        output, _ = _forward_step_helper(model, tokens2use, position_ids2use,
+                                         attention_mask, inference_params,
+                                         recv_buffer=recv_buffer,
+                                         is_first_stage=is_first_stage,
+                                         is_last_stage=is_last_stage)
 
         # Adjust the batch size offset to account for the micro-batch.
         inference_params.batch_size_offset += this_micro_batch_size
 
         # Copy logits.
-        if mpu.is_pipeline_last_stage():
+        if is_last_stage:
             logits[start:end, ...] = output
 
     # Once we are done with all the micro-batches, we can
@@ -181,34 +281,105 @@ def _with_pipelining_forward_step(model, tokens, position_ids, attention_mask,
     return logits
 
 
-def _allocate_early_exit_recv_buffers(batch_size, sequence_length):
-    if mpu.is_pipeline_first_stage():
-        return None
+def _recv_buffer_view(batch_size, sequence_length, recv_buffer_storage=None,
+                      device=None):
+    """[s, b, h] receive buffer, taken from recv_buffer_storage when it
+    is provided."""
+    if recv_buffer_storage is None:
+        return _allocate_recv_buffer(batch_size, sequence_length,
+                                     device=device)
+    hidden_size = get_args().hidden_size
+    numel = sequence_length * batch_size * hidden_size
+    assert numel <= recv_buffer_storage.numel(), \
+        'receive size exceeds the preallocated buffer'
+    return recv_buffer_storage[:numel].view(
+        sequence_length, batch_size, hidden_size)
+
+
+def _allocate_early_exit_buffer(batch_size, sequence_length, device=None):
+    """Flat buffer holding an [s, b, h] tensor followed by the early
+    exit signal so that both travel in a single p2p message."""
     args = get_args()
-    recv_size = (sequence_length, batch_size, args.hidden_size)
-    return [torch.empty(recv_size,
+    numel = sequence_length * batch_size * args.hidden_size + 1
+    if device is None:
+        device = torch.cuda.current_device()
+    return torch.empty(numel,
                        dtype=_get_recv_buffer_dtype(args),
-                       device=torch.cuda.current_device()),
-            torch.empty(1, dtype=torch.int8, device=torch.cuda.current_device())]
+                       device=device)
+
+
+def _early_exit_buffer_views(buffer, batch_size, sequence_length,
+                             hidden_size):
+    """Split a fused early exit message into the [s, b, h] tensor and
+    the one element signal."""
+    numel = sequence_length * batch_size * hidden_size
+    assert numel + 1 <= buffer.numel(), \
+        'message size exceeds the preallocated buffer'
+    return (buffer[:numel].view(sequence_length, batch_size, hidden_size),
+            buffer[numel:numel + 1])
+
+
+def _set_early_exit_signal(send_signal, recv_signal, has_early_exited):
+    """Forward the signal of the previous stage, or-ed with the exit
+    decision of this stage, without a round trip through the host."""
+    if recv_signal is None:
+        send_signal.zero_()
+    else:
+        send_signal.copy_(recv_signal)
+    if torch.is_tensor(has_early_exited):
+        send_signal.masked_fill_(has_early_exited.view(1), 1)
+    elif has_early_exited:
+        send_signal.fill_(1)
 
 
 def _with_early_exit_pipelining_forward_step(model, tokens, position_ids, attention_mask,
-                                  inference_params):
-    """No interleaving is supported."""
+                                  inference_params, recv_buffer_storage=None,
+                                  send_buffer_storage=None,
+                                  is_first_stage=None, is_last_stage=None,
+                                  hidden_size=None,
+                                  fp32_residual_connection=None,
+                                  device=None):
+    """No interleaving is supported. The hidden states and the early
+    exit signal are exchanged as a single message. If the buffer
+    storages are none, we will allocate them on the fly. The stage
+    flags and sizes are looked up if the caller does not provide them."""
     sequence_length = tokens.size(1)
     batch_size = tokens.size(0)
+    # The exit decision is made for the whole batch on its last
+    # sequence (see InferenceParams.do_early_exit).
     assert batch_size == 1, "early exit not support batch inference yet"
-    # Divide the batch dimension into micro batches.
+    if is_first_stage is None:
+        is_first_stage = mpu.is_pipeline_first_stage()
+    if is_last_stage is None:
+        is_last_stage = mpu.is_pipeline_last_stage()
+    if hidden_size is None:
+        hidden_size = get_args().hidden_size
     # Preallocate recv buffer.
-    if not mpu.is_pipeline_first_stage():
-        recv_buffers = _allocate_early_exit_recv_buffers(batch_size, sequence_length)
-        recv_list_from_prev_pipeline_rank(recv_buffers)
-        model.set_input_tensor(recv_buffers[0])
-        inference_params.prev_has_early_exited = bool(recv_buffers[1])
-    output_tensor = model(tokens, position_ids, attention_mask, inference_params=inference_params)
-    signal_tensor = torch.tensor([int(inference_params.has_early_exited or inference_params.prev_has_early_exited)],
-                                 dtype=torch.int8,
-                                 device=torch.cuda.current_device())
-    send_list_to_next_pipeline_rank([output_tensor, signal_tensor])
+    recv_signal = None
+    if not is_first_stage:
+        if recv_buffer_storage is None:
+            recv_buffer_storage = _allocate_early_exit_buffer(batch_size, sequence_length,
+                                                              device=device)
+        recv_tensor, recv_signal = _early_exit_buffer_views(
+            recv_buffer_storage, batch_size, sequence_length, hidden_size)
+        recv_from_prev_pipeline_rank_(
+            recv_buffer_storage[:recv_tensor.numel() + 1])
+        model.set_input_tensor(_get_input_tensor(recv_tensor,
+                                                 fp32_residual_connection))
+        # The early exit checks of this stage branch on it, and the
+        # receive has already synchronized the device.
+        inference_params.prev_has_early_exited = bool(recv_signal)
+    output_tensor, _ = model(tokens, position_ids, attention_mask, inference_params=inference_params)
+    if not is_last_stage:
+        if send_buffer_storage is None:
+            send_buffer_storage = _allocate_early_exit_buffer(batch_size, sequence_length,
+                                                              device=device)
+        send_tensor, send_signal = _early_exit_buffer_views(
+            send_buffer_storage, batch_size, sequence_length, hidden_size)
+        send_tensor.copy_(output_tensor)
+        _set_early_exit_signal(send_signal, recv_signal,
+                               inference_params.has_early_exited)
+        send_to_next_pipeline_rank(
+            send_buffer_storage[:send_tensor.numel() + 1])
     inference_params.sequence_len_offset += sequence_length
-    return output_tensor
\ No newline at end of file
+    return output_tensor
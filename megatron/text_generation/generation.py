@@ -2,6 +2,9 @@
 
 """Generation utilities."""
 
+import logging
+from functools import lru_cache
+
 import torch
 import torch.nn.functional as F
 
@@ -17,9 +20,11 @@ from .communication import (
     broadcast_from_last_to_first_pipeline_stage)
 from .inference_params import InferenceParams
 from .forward_step import ForwardStep
-from .sampling import sample
+from .sampling import sample, graphed_sample, greedy_sample_with_log_probs
 from .beam_utils import BeamHypotheses
 
+logger = logging.getLogger(__name__)
+
 def score_and_return_on_first_stage(model, tokens, lengths):
     """Function for just scoring.
     Arguments:
@@ -72,14 +77,13 @@ def score_and_return_on_first_stage(model, tokens, lengths):
         if mpu.is_pipeline_last_stage():
             # Always the last stage should have an output.
             assert logits is not None
-            log_probs = F.log_softmax(logits, dim=2)
             
             # Pick the tokens that we need to get the log
             # probabilities for. Note that next input token is
             # the token which we selected in the current logits,
             # so shift by 1.
-            indices = torch.unsqueeze(tokens[:, 1:], 2)
-            output_log_probs = torch.gather(log_probs, 2, indices).squeeze(2)
+            output_log_probs = _gather_log_probs(logits[:, :-1, :],
+                                                 tokens[:, 1:])
     
     # ======================================
     # Broadcast to the first pipeline stage.
@@ -105,7 +109,9 @@ def generate_tokens_probs_and_return_on_first_stage(
         print_max_prob=False,
         exit_layers=[],
         req_ids=[],
-        buffered_tokens:dict[int, torch.Tensor]={},):
+        buffered_tokens:dict[int, torch.Tensor]={},
+        num_scheduler_steps=8,
+        min_prompt_length=None,):
     """Main token generation function.
     Arguments:
         model: no interleaving is supported.
@@ -123,6 +129,14 @@ def generate_tokens_probs_and_return_on_first_stage(
         use_eod_token_for_early_termination: if True, do early termination if
             all the sequences have reached this token.
         prevent_newline_after_colon: if True, it will disable generating new line \n after :
+        num_scheduler_steps: number of decode steps between two checks of
+            the termination flag. The flag is copied to the host without
+            blocking and read one check later, so generation may run up to
+            2 * num_scheduler_steps - 1 tokens past the point where all
+            sequences are done. Those tokens are beyond
+            generated_sequence_lengths.
+        min_prompt_length: shortest prompt length if the caller already
+            has it on the host, otherwise it is read from lengths.
     Note: Outside of model, other parameters only need to be available on
           rank 0.
     Outputs: Note that is size is adjusted to a lower value than
@@ -137,7 +151,10 @@ def generate_tokens_probs_and_return_on_first_stage(
     tokenizer = get_tokenizer()
 
     batch_size = tokens.size(0)
-    min_prompt_length = lengths.min().item()
+    if min_prompt_length is None:
+        min_prompt_length = lengths.min().item()
+    tokens = _to_current_device(tokens)
+    lengths = _to_current_device(lengths)
     max_sequence_length = tokens.size(1)
 
     if max_sequence_length > args.max_position_embeddings:
@@ -156,7 +173,6 @@ def generate_tokens_probs_and_return_on_first_stage(
                                        print_max_prob=print_max_prob,
                                        exit_layers=exit_layers)
     
-    print("batch_size", batch_size)
     # forward step.
     forward_step = ForwardStep(model, inference_params=inference_params) # EarlyExitGPTModel.forward
 
@@ -166,6 +182,20 @@ def generate_tokens_probs_and_return_on_first_stage(
         termination_id = args.eos_id
     else:
         termination_id = tokenizer.eod
+    # Stop tokens arrive as a float broadcast, compare them as token ids.
+    if stop_tokens is not None and len(stop_tokens) > 0:
+        stop_tokens = stop_tokens.to(device=torch.cuda.current_device(),
+                                     dtype=torch.int64)
+    else:
+        stop_tokens = None
+    stop_mode = _early_stop_mode(stop_on_double_eol, stop_on_eol)
+
+    if prevent_newline_after_colon:
+        colon_id, newline_id = _special_token_id(':'), _special_token_id('\n')
+
+    # Fixed for the whole generation, looked up once.
+    is_first_stage = mpu.is_pipeline_first_stage()
+    is_last_stage = mpu.is_pipeline_last_stage()
 
     # ===================
     # Pre-allocate memory
@@ -176,18 +206,26 @@ def generate_tokens_probs_and_return_on_first_stage(
     output_log_probs_size = (batch_size, max_sequence_length - 1)
     # Lengths of generated seuquence including including prompts.
     generated_sequence_lengths = None
-    if mpu.is_pipeline_last_stage():
+    if is_last_stage:
         if return_output_log_probs:
-            output_log_probs = torch.empty(output_log_probs_size,
-                                           dtype=torch.float32,
-                                           device=torch.cuda.current_device())
-        generated_sequence_lengths = torch.ones(
+            # Scratch from the global buffer, a copy is returned.
+            output_log_probs = mpu.get_global_memory_buffer().get_tensor(
+                output_log_probs_size, torch.float32,
+                'text_generation_log_probs')
+        generated_sequence_lengths = torch.empty(
                 batch_size, dtype=torch.int64,
-                device=torch.cuda.current_device()) * max_sequence_length
+                device=torch.cuda.current_device()).fill_(max_sequence_length)
     
     # Whether we have reached a termination id.
-    is_generation_done = torch.zeros(batch_size, dtype=torch.uint8,
-                                     device=torch.cuda.current_device())
+    is_generation_done = mpu.get_global_memory_buffer().get_tensor(
+        (batch_size,), torch.uint8, 'text_generation_done').zero_()
+    # Rows past their prompt, rewritten in place every step.
+    started_buffer = torch.empty(batch_size, dtype=torch.bool,
+                                 device=lengths.device)
+    # Host copy of the termination flag and the event marking when the
+    # copy has landed.
+    done_host = torch.zeros(1, dtype=torch.uint8, pin_memory=True)
+    done_event = None
 
     # =============
     # Run infernece
@@ -203,29 +241,39 @@ def generate_tokens_probs_and_return_on_first_stage(
             # Pick the slice that we need to pass through the network.
             tokens2use = tokens[:, full_exit_context_length:context_length]
             positions2use = position_ids[:, full_exit_context_length:context_length]
-            attention_mask2use = attention_mask[
-                ..., full_exit_context_length:context_length, :context_length]
+            attention_mask2use = _slice_attention_mask(
+                attention_mask, full_exit_context_length, context_length)
 
             # logits will be meanigful only in the last pipeline stage.
-            print(f"[generate_tokens_probs] tokens2use size: {tokens2use.size()}")
             logits, exited_req_ids = forward_step(tokens2use, positions2use, attention_mask2use, req_ids=req_ids)
 
-            if mpu.is_pipeline_last_stage():
-                print(f"[generate_tokens_probs] exited_req_ids : {exited_req_ids}")
-                print(f"[generate_tokens_probs] logits size: {logits.size()}")
+            if is_last_stage:
                 assert len(exited_req_ids) == logits.size(0), "[generate_tokens_probs] error! length of exited_req_ids should be equal to the batch size of logits (size at idx 0)"
-                if prevent_newline_after_colon:
-                    logits[tokens2use[:, -1] == tokenizer.tokenize(':')[0], -1, tokenizer.tokenize('\n')[0]] = -1e10 # disable "\n" after ":"
                 # Always the last stage should have an output.
                 assert logits is not None
-
-                # Sample.
                 last_token_logits = logits[:, -1, :]
-                new_sample = sample(last_token_logits,
-                                    top_k=top_k,
-                                    top_p=top_p,
-                                    temperature=temperature,
-                                    vocab_size=tokenizer.vocab_size)
+                if prevent_newline_after_colon:
+                    # disable "\n" after ":"
+                    last_token_logits[:, newline_id].masked_fill_(
+                        tokens2use[:, -1] == colon_id, -1e10)
+
+                # Sample. Greedy is a plain argmax, no need for the sampler.
+                if top_k == 1 and top_p == 0.0:
+                    new_sample = torch.argmax(last_token_logits, dim=-1).clamp_(
+                        max=tokenizer.vocab_size - 1)
+                elif top_p_decay == 0.0:
+                    # Fixed sampling parameters, replay a captured graph.
+                    new_sample = graphed_sample(last_token_logits,
+                                                top_k=top_k,
+                                                top_p=top_p,
+                                                temperature=temperature,
+                                                vocab_size=tokenizer.vocab_size)
+                else:
+                    new_sample = sample(last_token_logits,
+                                        top_k=top_k,
+                                        top_p=top_p,
+                                        temperature=temperature,
+                                        vocab_size=tokenizer.vocab_size)
                 if top_p > 0.0 and top_p_decay > 0.0:
                     top_p = top_p * top_p_decay
                     if top_p_bound > 0.0:
@@ -233,11 +281,9 @@ def generate_tokens_probs_and_return_on_first_stage(
 
                 # If a prompt length is smaller or equal th current context
                 # length, it means we have started generating tokens
-                started = lengths <= context_length
+                started = torch.le(lengths, context_length, out=started_buffer)
 
                 # Update the tokens.
-                print(f"tokens size: {tokens.size()}")
-                print(f"new sample size: {new_sample.size()}")
                 # [TODO]Match the tokens to be the req_ids that EE:
 
                 exited_batch_size = len(exited_req_ids)
@@ -245,65 +291,74 @@ def generate_tokens_probs_and_return_on_first_stage(
                 assert exited_batch_size > 0, "[generate_tokens_probs] error! exited_batch_size should be greater than 0"
 
                 # Check if exited_req_ids are identical to req_ids
-                output_identical = len(exited_req_ids) == len(req_ids)
-                if output_identical:
-                    for idx in range(len(req_ids)):
-                        if exited_req_ids[idx] != req_ids[idx]:
-                            output_identical = False
-                            break
+                output_identical = list(exited_req_ids) == list(req_ids)
                 
                 if not output_identical:
                     # Step 1: Create tokens_before_generation to replace `tokens`. Each tensor in `tokens` has req_id corresponding to req_ids while each tensor in `tokens_before_generation` has req_id corresponding to exited_req_ids
-                    tokens_before_generation = torch.zeros(exited_batch_size, tokens.size(1), dtype=tokens.dtype, device=tokens.device)
-                    new_started = torch.zeros(exited_batch_size, dtype=torch.bool, device=started.device)
-                    idx_of_tokens_to_be_put_in_buffered_tokens = list(range(len(req_ids)))
+                    # Work out on the host which row every exited request comes
+                    # from, then move all rows of one source with a single gather.
+                    row_of_req_id = {req_id: row for row, req_id in enumerate(req_ids)}
+                    from_tokens_positions, from_tokens_rows = [], []
+                    from_buffer_positions, from_buffer_req_ids = [], []
                     for position_idx, exited_req_id in enumerate(exited_req_ids):
-                        if exited_req_id in req_ids:
-                            # Locate token in tokens and assign it to the corresponding position in tokens_before_generation
-                            pos_idx_in_tokens = req_ids.index(exited_req_id)
-                            tokens_before_generation[position_idx] = tokens[pos_idx_in_tokens].clone()
-                            new_started[position_idx] = started[pos_idx_in_tokens]
-
-                            # Remove the token from the list of tokens to be put in buffered_tokens
-                            idx_of_tokens_to_be_put_in_buffered_tokens.remove(pos_idx_in_tokens)
+                        row = row_of_req_id.get(exited_req_id)
+                        if row is not None:
+                            from_tokens_positions.append(position_idx)
+                            from_tokens_rows.append(row)
                         else:
-                            # Find the token in buffered_tokens and assign it to the corresponding position in tokens_before_generation
-                            # started status must be True
+                            # Find the token in buffered_tokens, started status must be True
                             assert exited_req_id in buffered_tokens, "[generate_tokens_probs] error! exited_req_id should be in buffered_tokens"
-                            tokens_before_generation[position_idx] = buffered_tokens[exited_req_id].clone()
-                            new_started[position_idx] = True
-                    
+                            from_buffer_positions.append(position_idx)
+                            from_buffer_req_ids.append(exited_req_id)
+
+                    tokens_before_generation = torch.empty(exited_batch_size, tokens.size(1), dtype=tokens.dtype, device=tokens.device)
+                    new_started = torch.ones(exited_batch_size, dtype=torch.bool, device=started.device)
+                    if len(from_tokens_positions) > 0:
+                        positions = torch.tensor(from_tokens_positions, dtype=torch.int64, device=tokens.device)
+                        rows = torch.tensor(from_tokens_rows, dtype=torch.int64, device=tokens.device)
+                        tokens_before_generation.index_copy_(0, positions, tokens.index_select(0, rows))
+                        new_started.index_copy_(0, positions, started.index_select(0, rows))
+                    if len(from_buffer_positions) > 0:
+                        positions = torch.tensor(from_buffer_positions, dtype=torch.int64, device=tokens.device)
+                        tokens_before_generation.index_copy_(
+                            0, positions, torch.stack([buffered_tokens[req_id] for req_id in from_buffer_req_ids]))
+
                     # Step 2: Put tokens that are not in exited_req_ids to buffered_tokens
-                    for position_idx in idx_of_tokens_to_be_put_in_buffered_tokens:
-                        req_id = req_ids[position_idx]
-                        buffered_tokens[req_id] = tokens[position_idx].clone()
+                    taken_rows = set(from_tokens_rows)
+                    rows_to_buffer = [row for row in range(len(req_ids)) if row not in taken_rows]
+                    if len(rows_to_buffer) > 0:
+                        rows = torch.tensor(rows_to_buffer, dtype=torch.int64, device=tokens.device)
+                        for row, row_tokens in zip(rows_to_buffer, tokens.index_select(0, rows).unbind(0)):
+                            buffered_tokens[req_ids[row]] = row_tokens
                     
                     # Step 3: Update tokens
                     tokens = tokens_before_generation
                     started = new_started
                 
-                
-                print(f"new tokens size: {tokens.size()}")
-                print(f"new sample size: {new_sample.size()}")
-                print(f"used started: {started}")
-                print(f"context_length: {context_length}")
-                tokens[started, context_length] = new_sample[started]
+                _write_started_rows(tokens[:, context_length], new_sample,
+                                    started)
 
                 # Calculate the log probabilities.
-                if return_output_log_probs:
-                    log_probs = F.log_softmax(logits, dim=2)
+                if return_output_log_probs and \
+                        context_length - prev_context_length == 1:
+                    # Decode step: only the token we just selected.
+                    output_log_probs[:, context_length - 1] = \
+                        _gather_log_probs(last_token_logits,
+                                          tokens[:, context_length])
+                elif return_output_log_probs:
                     # Pick the tokens that we need to get the log
                     # probabilities for. Note that next input token is
                     # the token which we selected in the current logits,
                     # so shift by 1.
-                    indices = torch.unsqueeze(
-                        tokens[
-                            :,
-                            (prev_context_length + 1):(context_length + 1)],
-                        2)
+                    indices = tokens[
+                        :, (prev_context_length + 1):(context_length + 1)]
                     output_log_probs[:,
                                         prev_context_length:context_length] = \
-                        torch.gather(log_probs, 2, indices).squeeze(2)
+                        _gather_log_probs(logits[:, -indices.size(1):, :],
+                                          indices)
+
+            # Release the [b, s, v] logits before the next forward step.
+            logits = last_token_logits = None
 
             # Update the tokens on the first stage so the next input to
             # the network is correct.
@@ -319,37 +374,40 @@ def generate_tokens_probs_and_return_on_first_stage(
             inference_params.is_first_step = False
 
             # Check if all the sequences have hit the termination_id.
-            done = None
-            if mpu.is_pipeline_last_stage():
-                # TODO(rprenger) These stopping methods are tokenizer dependent
-                # instead tokenization should be in the inference loop so stop sequences can be used
-                if stop_tokens is not None and len(stop_tokens) > 0:
-                    done_token = torch.any(
-                        new_sample.expand(stop_tokens.shape[0], new_sample.shape[0]) == stop_tokens.unsqueeze(dim=1), dim=0) \
-                        & started.byte()
-
-                else: 
-                    done_token = (new_sample == termination_id).byte() & \
-                        started.byte()
-                
-                just_finished = (done_token & ~is_generation_done).bool()
-                generated_sequence_lengths[just_finished.view(-1)] = \
-                    context_length + 1
-                is_generation_done = is_generation_done | done_token
-                done = torch.all(is_generation_done)
-            done = broadcast_from_last_pipeline_stage(1, torch.uint8,
-                                                      tensor=done)
-            if use_stop_tokens_for_early_termination and done:
-                break
+            if is_last_stage:
+                is_generation_done = _early_stop_update(
+                    new_sample, tokens, context_length, termination_id,
+                    stop_tokens, started, is_generation_done,
+                    generated_sequence_lengths, stop_mode)
+
+            # Only look at the termination flag every num_scheduler_steps
+            # steps. The flag of the previous check was copied to pinned
+            # memory without blocking and has normally landed by now, so
+            # the host keeps queueing decode steps. Every rank reads the
+            # same check, so they all stop at the same step.
+            if use_stop_tokens_for_early_termination and \
+               (context_length - min_prompt_length + 1) % num_scheduler_steps == 0:
+                if done_event is not None:
+                    done_event.synchronize()
+                    if done_host.item():
+                        break
+                done = None
+                if is_last_stage:
+                    done = torch.all(is_generation_done).byte().view(1)
+                done = broadcast_from_last_pipeline_stage(1, torch.uint8,
+                                                          tensor=done)
+                done_host.copy_(done, non_blocking=True)
+                done_event = torch.cuda.Event()
+                done_event.record()
             
     # ===================================================
     # Update the length of based on max generated length.
     # ===================================================
 
     tokens = tokens[:, :(context_length + 1)]
-    if mpu.is_pipeline_last_stage():
+    if is_last_stage:
         if return_output_log_probs:
-            output_log_probs = output_log_probs[:, :context_length].contiguous()
+            output_log_probs = output_log_probs[:, :context_length].clone()
 
     # ======================================
     # Broadcast to the first pipeline stage.
@@ -361,22 +419,21 @@ def generate_tokens_probs_and_return_on_first_stage(
         output_log_probs_size = (batch_size, context_length)
         output_log_probs = broadcast_from_last_to_first_pipeline_stage(
             output_log_probs_size, torch.float32, output_log_probs)
-    if not echo_prompts and mpu.is_pipeline_first_stage():
+    if not echo_prompts and is_first_stage:
         generated_sequence_lengths -= lengths
-        for i, (sequence, length) in enumerate(zip(tokens, lengths)):
-            tokens[i] = sequence.roll(-length.item(), dims=0)
+        tokens = _roll_rows_left(tokens, lengths)
         if return_output_log_probs:
-            for i, (prob, length) in enumerate(zip(output_log_probs, lengths)):
-                output_log_probs[i] = prob.roll(-(length.item() - 1), dims=0)
+            output_log_probs = _roll_rows_left(output_log_probs, lengths - 1)
     return tokens, generated_sequence_lengths, output_log_probs, None, exited_req_ids, buffered_tokens
 
-def beam_search_and_return_on_first_stage(model, tokens, lengths, beam_size, stop_token, num_return_gen, length_penalty, prevent_newline_after_colon=True):
+def beam_search_and_return_on_first_stage(model, tokens, lengths, beam_size, stop_token, num_return_gen, length_penalty, prevent_newline_after_colon=True, prompt_length=None):
     args = get_args()
     tokenizer = get_tokenizer()
 
     batch_size = tokens.size(0)
     assert(batch_size == 1)
-    prompt_length = lengths.item()
+    if prompt_length is None:
+        prompt_length = lengths.item()
     final_sequence_length = tokens.size(1)
     final_sequence_length = min(final_sequence_length, args.max_position_embeddings)
     
@@ -387,6 +444,10 @@ def beam_search_and_return_on_first_stage(model, tokens, lengths, beam_size, sto
     # forward step.
     forward_step = ForwardStep(model, beam_size, final_sequence_length)
 
+    # Fixed for the whole generation, looked up once.
+    is_first_stage = mpu.is_pipeline_first_stage()
+    is_last_stage = mpu.is_pipeline_last_stage()
+
     beam_hyp = BeamHypotheses(beam_size, length_penalty)
     best_batches = None
     done = torch.zeros(1, dtype=torch.uint8, device=torch.cuda.current_device())
@@ -398,7 +459,10 @@ def beam_search_and_return_on_first_stage(model, tokens, lengths, beam_size, sto
     # Run infernece
     # =============
     with torch.no_grad():
-        tokens = tokens.repeat(beam_size, 1)
+        # All beams start from the same prompt. The last stage replaces
+        # tokens with the selected beams after the first step, so a view
+        # is enough until then.
+        tokens = tokens.expand(beam_size, -1)
         attention_mask, position_ids = _build_attention_mask_and_position_ids(tokens)
         prev_context_length = 0
         for context_length in range(prompt_length, final_sequence_length):
@@ -406,56 +470,66 @@ def beam_search_and_return_on_first_stage(model, tokens, lengths, beam_size, sto
             # Pick the slice that we need to pass through the network.
             tokens2use = tokens[:, prev_context_length:context_length]
             positions2use = position_ids[:, prev_context_length:context_length]
-            attention_mask2use = attention_mask[
-                ..., prev_context_length:context_length, :context_length]
+            attention_mask2use = _slice_attention_mask(
+                attention_mask, prev_context_length, context_length)
 
             # logits will be meanigful only in the last pipeline stage.
             logits = forward_step(tokens2use, positions2use, attention_mask2use)
 
-            if mpu.is_pipeline_last_stage():
+            if is_last_stage:
                 if prevent_newline_after_colon:
-                    logits[tokens2use[:, -1] == tokenizer.tokenize(':')[0], -1, tokenizer.tokenize('\n')[0]] = -1e10 # disable "\n" after ":"
+                    colon_id, newline_id = _special_token_id(':'), _special_token_id('\n')
+                    logits[tokens2use[:, -1] == colon_id, -1, newline_id] = -1e10 # disable "\n" after ":"
                 vocab_size = logits.size(2)
-                log_probs = F.log_softmax(logits, dim=2)
-                new_scores = log_probs[:, -1, :] + scores
+                # Only the last position is scored, normalize just that.
+                new_scores = F.log_softmax(logits[:, -1, :], dim=1) + scores
+                # Release the [b, s, v] logits before the next forward step.
+                logits = None
 
+                # Only the best 2 * beam_size candidates are looked at, so
+                # a top-k is enough, no need to sort all of them.
                 if context_length == prompt_length:  # if this is the first one
-                    sorted_scores, indices = torch.sort(new_scores[0,:], descending=True)
+                    best_scores, indices = torch.topk(new_scores[0,:], 2 * beam_size)
                 else:
-                    sorted_scores, indices = torch.sort(new_scores.view(-1), descending=True)
-
-                best_beam_ids = torch.div(indices[: 2 * beam_size], vocab_size).trunc().long()
-                best_words = indices[:2 * beam_size] % vocab_size
-                best_scores = sorted_scores[: 2 * beam_size]
-
-                next_beams = []
-                for beam_token_rank, (token_id, beam_score, beam_id) in enumerate(
-                    zip(best_words, best_scores, best_beam_ids)
+                    best_scores, indices = torch.topk(new_scores.view(-1), 2 * beam_size)
+
+                best_beam_ids = torch.div(indices, vocab_size, rounding_mode='floor')
+                best_words = indices % vocab_size
+
+                # Bring the stop flags, beam ids and scores of the candidates
+                # to the host with a single copy and select there.
+                is_stop, beam_ids, beam_scores = torch.stack(
+                    (best_words.eq(stop_token).float(), best_beam_ids.float(),
+                     best_scores.float())).tolist()
+                next_ranks = []
+                for beam_token_rank, (token_is_stop, beam_id) in enumerate(
+                    zip(is_stop, beam_ids)
                 ):
-                    if token_id.item() == stop_token:
+                    if token_is_stop:
                         # if beam_token does not belong to top num_beams tokens, it should not be added
                         is_beam_token_worse_than_top_num_beams = beam_token_rank >= beam_size
                         if is_beam_token_worse_than_top_num_beams:
                             continue
                         beam_hyp.add(
-                            tokens[beam_id].clone(),
-                            beam_score,
+                            tokens[int(beam_id)].clone(),
+                            best_scores[beam_token_rank],
                             context_length + 1 - prompt_length
                         )
                     else:
                         # add next predicted token since it is not eos_token
-                        next_beams.append((token_id, beam_score, beam_id))
+                        next_ranks.append(beam_token_rank)
 
-                    if len(next_beams) == beam_size:
+                    if len(next_ranks) == beam_size:
                         break
 
-                if beam_hyp.is_done(best_scores.max().item(), context_length + 1 - prompt_length):
+                if beam_hyp.is_done(max(beam_scores), context_length + 1 - prompt_length):
                     done = torch.ones(1, dtype=torch.uint8, device=torch.cuda.current_device())
             
-                best_batches = tokens.new([item[2] for item in next_beams])
+                next_ranks = torch.tensor(next_ranks, dtype=torch.int64, device=best_words.device)
+                best_batches = best_beam_ids.index_select(0, next_ranks)
                 tokens = tokens[best_batches,:]
-                tokens[:, context_length] = tokens.new([item[0] for item in next_beams])
-                scores = scores.new([item[1] for item in next_beams]).unsqueeze(1)
+                tokens[:, context_length] = best_words.index_select(0, next_ranks)
+                scores = best_scores.index_select(0, next_ranks).unsqueeze(1)
           
             # torch.distributed.barrier()
             done = broadcast_from_last_pipeline_stage(1, torch.uint8, done)
@@ -463,7 +537,10 @@ def beam_search_and_return_on_first_stage(model, tokens, lengths, beam_size, sto
                 break
 
             # Update the tokens on the first stage so the next input to
-            # the network is correct.
+            # the network is correct. The copy is in place, so the beams
+            # need their own rows there.
+            if is_first_stage and not tokens.is_contiguous():
+                tokens = tokens.contiguous()
             copy_from_last_to_first_pipeline_stage(tokens.size(), torch.int64,
                                                    tokens)
 
@@ -474,7 +551,7 @@ def beam_search_and_return_on_first_stage(model, tokens, lengths, beam_size, sto
             # Update the context length for the next token generation.
             prev_context_length = context_length
 
-        if mpu.is_pipeline_last_stage():
+        if is_last_stage:
             # if cannot find stop token, add open beams to hyps
             if not done:
                 for beam_id in range(beam_size):
@@ -513,7 +590,9 @@ def generate_with_pipelined_early_exit_and_return_on_first_stage(
         early_exit_thres=1.0,
         use_early_exit=False,
         print_max_prob=False,
-        exit_layers=[]
+        exit_layers=[],
+        min_prompt_length=None,
+        num_scheduler_steps=8,
 ):
     """Main token generation function.
     Arguments:
@@ -532,6 +611,11 @@ def generate_with_pipelined_early_exit_and_return_on_first_stage(
         use_eod_token_for_early_termination: if True, do early termination if
             all the sequences have reached this token.
         prevent_newline_after_colon: if True, it will disable generating new line \n after :
+        min_prompt_length: shortest prompt length if the caller already
+            has it on the host, otherwise it is read from lengths.
+        num_scheduler_steps: number of decode steps between two checks of
+            the termination flag, see
+            generate_tokens_probs_and_return_on_first_stage.
     Note: Outside of model, other parameters only need to be available on
           rank 0.
     Outputs: Note that is size is adjusted to a lower value than
@@ -546,7 +630,10 @@ def generate_with_pipelined_early_exit_and_return_on_first_stage(
     tokenizer = get_tokenizer()
 
     batch_size = tokens.size(0)
-    min_prompt_length = lengths.min().item()
+    if min_prompt_length is None:
+        min_prompt_length = lengths.min().item()
+    tokens = _to_current_device(tokens)
+    lengths = _to_current_device(lengths)
     max_sequence_length = tokens.size(1)
 
     if max_sequence_length > args.max_position_embeddings:
@@ -574,6 +661,18 @@ def generate_with_pipelined_early_exit_and_return_on_first_stage(
         termination_id = args.eos_id
     else:
         termination_id = tokenizer.eod
+    # Stop tokens arrive as a float broadcast, compare them as token ids.
+    if stop_tokens is not None and len(stop_tokens) > 0:
+        stop_tokens = stop_tokens.to(device=torch.cuda.current_device(),
+                                     dtype=torch.int64)
+    else:
+        stop_tokens = None
+    stop_mode = _early_stop_mode(stop_on_double_eol, stop_on_eol)
+
+    # Fixed for the whole generation, looked up once.
+    is_first_stage = mpu.is_pipeline_first_stage()
+    is_last_stage = mpu.is_pipeline_last_stage()
+    has_early_exit = mpu.has_early_exit()
 
     # ===================
     # Pre-allocate memory
@@ -584,18 +683,40 @@ def generate_with_pipelined_early_exit_and_return_on_first_stage(
     output_log_probs_size = (batch_size, max_sequence_length - 1)
     # Lengths of generated seuquence including including prompts.
     generated_sequence_lengths = None
-    if mpu.is_pipeline_first_stage() or mpu.is_pipeline_last_stage() or mpu.has_early_exit():
+    if is_first_stage or is_last_stage or has_early_exit:
         output_log_probs = torch.empty(output_log_probs_size,
                                         dtype=torch.float32,
                                         device=torch.cuda.current_device())
-    if mpu.is_pipeline_first_stage():
-        generated_sequence_lengths = torch.ones(
+    if is_first_stage:
+        generated_sequence_lengths = torch.empty(
                 batch_size, dtype=torch.int64,
-                device=torch.cuda.current_device()) * max_sequence_length
+                device=torch.cuda.current_device()).fill_(max_sequence_length)
+        # Where the tokens and log probs of every step are received.
+        new_sample = mpu.get_global_memory_buffer().get_tensor(
+            (batch_size,), torch.int64, 'text_generation_new_sample')
+        new_log_probs = mpu.get_global_memory_buffer().get_tensor(
+            (batch_size,), torch.float32, 'text_generation_new_log_probs')
     
     # Whether we have reached a termination id.
-    is_generation_done = torch.zeros(batch_size, dtype=torch.uint8,
-                                     device=torch.cuda.current_device())
+    is_generation_done = mpu.get_global_memory_buffer().get_tensor(
+        (batch_size,), torch.uint8, 'text_generation_done').zero_()
+    # Rows past their prompt, rewritten in place every step.
+    started_buffer = torch.empty(batch_size, dtype=torch.bool,
+                                 device=lengths.device)
+    # Host copy of the termination flag and the event marking when the
+    # copy has landed.
+    done_host = torch.zeros(1, dtype=torch.uint8, pin_memory=True)
+    done_event = None
+
+    if is_last_stage:
+        # What the last stage sends to the first one every step, and
+        # the selected logits its log prob is computed from.
+        token_send_buffer = torch.empty(batch_size, dtype=torch.int64,
+                                        device=torch.cuda.current_device())
+        log_prob_send_buffer = torch.empty(batch_size, dtype=torch.float32,
+                                           device=torch.cuda.current_device())
+        selected_logits = torch.empty((batch_size, 1), dtype=torch.float32,
+                                      device=torch.cuda.current_device())
 
     # =============
     # Run infernece
@@ -611,8 +732,8 @@ def generate_with_pipelined_early_exit_and_return_on_first_stage(
             # Pick the slice that we need to pass through the network.
             tokens2use = tokens[:, prev_context_length:context_length]
             positions2use = position_ids[:, prev_context_length:context_length]
-            attention_mask2use = attention_mask[
-                ..., prev_context_length:context_length, :context_length]
+            attention_mask2use = _slice_attention_mask(
+                attention_mask, prev_context_length, context_length)
 
             # clear inference states
             inference_params.clear_early_exit_states()
@@ -620,29 +741,36 @@ def generate_with_pipelined_early_exit_and_return_on_first_stage(
             # logits will be meanigful only in the last pipeline stage.
             logits = forward_step(tokens2use, positions2use, attention_mask2use)
 
-            if mpu.is_pipeline_last_stage() and not (inference_params.has_early_exited or inference_params.prev_has_early_exited):
+            if is_last_stage and not (inference_params.has_early_exited or inference_params.prev_has_early_exited):
                 last_token_logits = logits[:, -1, :]
 
-                # Calculate the log probabilities.
-                log_probs = F.log_softmax(logits, dim=2)
-                max_log_prob, token_id =  torch.max(log_probs[:, -1, :], dim=1)
-                token = tokenizer.detokenize([int(token_id[-1])])
+                # Calculate the log probabilities. Only the last token is
+                # sent to the first stage, so normalize just that row:
+                # log_softmax(x) = x - logsumexp(x).
+                greedy = top_k == 1 and top_p == 0.0
+                if greedy:
+                    # The sample is the argmax, so one pass gives the
+                    # token, the max log prob and the log prob to send.
+                    token_id, max_log_prob = greedy_sample_with_log_probs(
+                        last_token_logits, vocab_size=tokenizer.vocab_size)
+                else:
+                    last_token_lse = torch.logsumexp(last_token_logits, dim=1)
+                    max_logit, token_id = torch.max(last_token_logits, dim=1)
+                    max_log_prob = max_logit - last_token_lse
                 if print_max_prob:
+                    token = tokenizer.detokenize([int(token_id[-1])])
                     print(f"layer final: token [{token}], prob {float(torch.exp(max_log_prob[-1]))}")
                 inference_params.has_early_exited = max_log_prob[-1] >= inference_params.early_exit_thres
-                # Printout the max prob
-                print("!!!!!!!")
-                print(inference_params.has_early_exited)
-                print("!!!!!!!")
-                if inference_params.has_early_exited:
-                    print("-----------------")
-                    print(f"max log prob: {max_log_prob[-1]}, early exit thres: {inference_params.early_exit_thres}")
-                    print("-----------------")
-                new_sample = sample(last_token_logits,
-                                    top_k=top_k,
-                                    top_p=top_p,
-                                    temperature=temperature,
-                                    vocab_size=tokenizer.vocab_size)
+                logger.debug("max log prob: %s, early exit thres: %s",
+                             max_log_prob[-1], inference_params.early_exit_thres)
+                if greedy:
+                    new_sample = token_id
+                else:
+                    new_sample = sample(last_token_logits,
+                                        top_k=top_k,
+                                        top_p=top_p,
+                                        temperature=temperature,
+                                        vocab_size=tokenizer.vocab_size)
                 if top_p > 0.0 and top_p_decay > 0.0:
                     top_p = top_p * top_p_decay
                     if top_p_bound > 0.0:
@@ -650,100 +778,252 @@ def generate_with_pipelined_early_exit_and_return_on_first_stage(
 
                 # If a prompt length is smaller or equal th current context
                 # length, it means we have started generating tokens
-                started = lengths <= context_length
+                started = torch.le(lengths, context_length, out=started_buffer)
                 # Update the tokens.
-                tokens[started, context_length] = new_sample[started]
-                # Pick the tokens that we need to get the log
-                # probabilities for. Note that next input token is
-                # the token which we selected in the current logits,
-                # so shift by 1.
-                indices = torch.unsqueeze(
-                    tokens[
-                        :,
-                        (prev_context_length + 1):(context_length + 1)],
-                    2)
-                output_log_probs[:,
-                                    prev_context_length:context_length] = \
-                    torch.gather(log_probs, 2, indices).squeeze(2)
+                _write_started_rows(tokens[:, context_length], new_sample,
+                                    started)
+                # Log probability of the token which we selected in the
+                # current logits, i.e. the next input token. The first
+                # stage only keeps it for the started rows.
+                token_send_buffer.copy_(tokens[:, context_length])
+                # The log prob is always sent, but only filled in when the
+                # caller asked for it.
+                if return_output_log_probs:
+                    if greedy:
+                        log_prob_send_buffer.copy_(max_log_prob)
+                    else:
+                        torch.gather(last_token_logits, 1,
+                                     token_send_buffer.unsqueeze(1),
+                                     out=selected_logits)
+                        torch.sub(selected_logits.squeeze(1), last_token_lse,
+                                  out=log_prob_send_buffer)
+                    output_log_probs[:, context_length - 1] = log_prob_send_buffer
                 send_token_and_probs_to_first_pipeline_stage(inference_params=inference_params,
-                                                             token_tensor=tokens[:, context_length],
-                                                             prob_tensor=output_log_probs[:, context_length - 1],
+                                                             token_tensor=token_send_buffer,
+                                                             prob_tensor=log_prob_send_buffer,
                                                              is_final=True)
-            elif mpu.is_pipeline_first_stage():
+            elif is_first_stage:
                 recv_token_and_probs(inference_params=inference_params, 
-                                     token_tensor_buffer=tokens[:, context_length],
-                                     prob_tensor_buffer=output_log_probs[:, context_length - 1])
-            elif mpu.has_early_exit() and not(inference_params.has_early_exited or inference_params.prev_has_early_exited):
+                                     token_tensor_buffer=new_sample,
+                                     prob_tensor_buffer=new_log_probs)
+                # Only overwrite the sequences that are past their prompt.
+                started = torch.le(lengths, context_length, out=started_buffer)
+                _write_started_rows(tokens[:, context_length], new_sample,
+                                    started)
+                if return_output_log_probs:
+                    _write_started_rows(output_log_probs[:, context_length - 1],
+                                        new_log_probs, started)
+            elif has_early_exit and not(inference_params.has_early_exited or inference_params.prev_has_early_exited):
                 send_token_and_probs_to_first_pipeline_stage(inference_params=inference_params)
 
+            # Release the [b, s, v] logits before the next forward step.
+            logits = last_token_logits = None
+
             # Update the context length for the next token generation.
             prev_context_length = context_length
             inference_params.is_first_step = False
 
-            # Check if all the sequences have hit the termination_id.
-            # done = None
-            # if mpu.is_pipeline_first_stage():
-            #     # TODO(rprenger) These stopping methods are tokenizer dependent
-            #     # instead tokenization should be in the inference loop so stop sequences can be used
-            #     if stop_on_double_eol:
-            #         hit_double_eol = (new_sample == 628).byte() & started.byte()
-            #         hit_two_eols = (new_sample == 198).byte() & (tokens[:, context_length-1] == 198).byte() & started.byte()
-            #         done_token = hit_double_eol | hit_two_eols
-            #     elif stop_on_eol:
-            #         hit_double_eol = (new_sample == 628).byte() & started.byte()
-            #         hit_eol = (new_sample == 198).byte() & started.byte()
-            #         done_token = hit_double_eol | hit_eol
-            #     else: 
-            #         done_token = (new_sample == termination_id).byte() & \
-            #             started.byte()
-
-            #     just_finished = (done_token & ~is_generation_done).bool()
-            #     generated_sequence_lengths[just_finished.view(-1)] = \
-            #         context_length + 1
-            #     is_generation_done = is_generation_done | done_token
-            #     done = torch.all(is_generation_done)
-            # done = broadcast_from_first_pipeline_stage(1, torch.uint8,
-            #                                           tensor=done)
-            # if use_stop_tokens_for_early_termination and done:
-            #     break
+            # Check if all the sequences have hit the termination_id. The
+            # first stage receives every token, whichever stage exited.
+            if is_first_stage:
+                is_generation_done = _early_stop_update(
+                    new_sample, tokens, context_length, termination_id,
+                    stop_tokens, started, is_generation_done,
+                    generated_sequence_lengths, stop_mode)
+
+            # Only look at the termination flag every num_scheduler_steps
+            # steps, through a non-blocking host copy read one check later
+            # (see generate_tokens_probs_and_return_on_first_stage).
+            if use_stop_tokens_for_early_termination and \
+               (context_length - min_prompt_length + 1) % num_scheduler_steps == 0:
+                if done_event is not None:
+                    done_event.synchronize()
+                    if done_host.item():
+                        break
+                done = None
+                if is_first_stage:
+                    done = torch.all(is_generation_done).byte().view(1)
+                done = broadcast_from_first_pipeline_stage(1, torch.uint8,
+                                                           tensor=done)
+                done_host.copy_(done, non_blocking=True)
+                done_event = torch.cuda.Event()
+                done_event.record()
 
     # ===================================================
     # Update the length of based on max generated length.
     # ===================================================
 
-    # tokens = tokens[:, :(context_length + 1)]
-    # if mpu.is_pipeline_last_stage():
-    #     if return_output_log_probs:
-    #         output_log_probs = output_log_probs[:, :context_length]
+    if is_first_stage:
+        tokens = tokens[:, :(context_length + 1)]
+        if return_output_log_probs:
+            output_log_probs = output_log_probs[:, :context_length]
 
     # ======================================
     # Broadcast to the first pipeline stage.
     # ======================================
 
-    # if return_output_log_probs:
-    #     output_log_probs_size = (batch_size, context_length)
-    #     output_log_probs = broadcast_from_last_to_first_pipeline_stage(
-    #         output_log_probs_size, torch.float32, output_log_probs)
-    if not echo_prompts and mpu.is_pipeline_first_stage():
+    if not echo_prompts and is_first_stage:
         generated_sequence_lengths -= lengths
-        for i, (sequence, length) in enumerate(zip(tokens, lengths)):
-            tokens[i] = sequence.roll(-length.item(), dims=0)
+        tokens = _roll_rows_left(tokens, lengths)
         if return_output_log_probs:
-            for i, (prob, length) in enumerate(zip(output_log_probs, lengths)):
-                output_log_probs[i] = prob.roll(-(length.item() - 1), dims=0)
+            output_log_probs = _roll_rows_left(output_log_probs, lengths - 1)
     return tokens, generated_sequence_lengths, output_log_probs, None
 
 
+@lru_cache(maxsize=None)
+def _special_token_ids(text):
+    """Token ids that text adds when it follows other text. Encoding text
+    alone is not enough: a tokenizer can prepend ids to every encoding,
+    e.g. the BOS id and the dummy-prefix '▁' piece of SentencePiece.
+    The tokenizer is global, so every text is tokenized once per process."""
+
+    tokenizer = get_tokenizer()
+    prefix = list(tokenizer.tokenize('a'))
+    ids = list(tokenizer.tokenize('a' + text))
+    assert ids[:len(prefix)] == prefix, \
+        'cannot find the token ids of {!r}'.format(text)
+    return tuple(ids[len(prefix):])
+
+
+def _special_token_id(text):
+    """Id of the single token that text is encoded to."""
+
+    ids = _special_token_ids(text)
+    assert len(ids) == 1, '{!r} is not a single token'.format(text)
+    return ids[0]
+
+
+def _early_stop_mode(stop_on_double_eol, stop_on_eol):
+    """Mode of _early_stop_update for the stop_on_* flags."""
+
+    if stop_on_double_eol:
+        return 'double_eol'
+    if stop_on_eol:
+        return 'eol'
+    return 'eos'
+
+
+def _early_stop_update(new_sample, tokens, context_length, termination_id,
+                       stop_tokens, started, is_generation_done,
+                       generated_sequence_lengths, mode):
+    """Mark the rows whose new_sample ends the generation and record their
+    length, all on the device. mode is one of:
+        eos: new_sample is one of stop_tokens, or termination_id
+        eol: new_sample is a newline or a double newline
+        double_eol: a double newline, or a newline after a newline
+    Returns the updated is_generation_done."""
+
+    # TODO(rprenger) These stopping methods are tokenizer dependent
+    # instead tokenization should be in the inference loop so stop sequences can be used
+    if mode == 'eos':
+        if stop_tokens is not None:
+            done_token = torch.isin(new_sample, stop_tokens)
+        else:
+            done_token = new_sample.eq(termination_id)
+    else:
+        eol_id = _special_token_id('\n')
+        done_token = new_sample.eq(eol_id)
+        if mode == 'double_eol':
+            done_token &= tokens[:, context_length - 1].eq(eol_id)
+        # Tokenizers without a merged double newline piece (e.g.
+        # SentencePiece) only see it as two newlines in a row.
+        double_eol_ids = _special_token_ids('\n\n')
+        if len(double_eol_ids) == 1:
+            done_token |= new_sample.eq(double_eol_ids[0])
+    return _mark_finished(done_token, started, is_generation_done,
+                          generated_sequence_lengths, context_length)
+
+
+@torch.jit.script
+def _mark_finished(done_token, started, is_generation_done,
+                   generated_sequence_lengths, context_length: int):
+    """Tail of _early_stop_update, scripted so the mask updates fuse.
+    masked_fill_ instead of a boolean index keeps it free of host syncs."""
+
+    done_token = (done_token & started).byte()
+    just_finished = (done_token & ~is_generation_done).bool()
+    generated_sequence_lengths.masked_fill_(just_finished, context_length + 1)
+    return is_generation_done | done_token
+
+
+@torch.jit.script
+def _write_started_rows(column, values, started):
+    """column[started] = values[started], in place. A boolean index
+    counts the selected rows on the host, torch.where does not."""
+
+    column.copy_(torch.where(started, values, column))
+
+
+def _slice_attention_mask(attention_mask, start, end):
+    """Rows [start, end) and columns [:end] of the attention mask. A
+    single decode row is already contiguous; a block of rows (prefill,
+    or the recompute after an early exit) is copied into a reusable
+    buffer so the attention kernels get a dense mask."""
+
+    mask = attention_mask[..., start:end, :end]
+    if mask.is_contiguous():
+        return mask
+    return mpu.get_global_memory_buffer().get_tensor(
+        mask.size(), mask.dtype, 'text_generation_attention_mask').copy_(mask)
+
+
+def _to_current_device(tensor):
+    """Move a host tensor to the current device through pinned memory, so
+    the copy does not block the host. Device tensors are returned as is."""
+
+    if tensor.is_cuda:
+        return tensor
+    return tensor.pin_memory().to(torch.cuda.current_device(),
+                                  non_blocking=True)
+
+
+@torch.jit.script
+def _roll_rows_left(tensor, shifts):
+    """Roll every row of a [b, s] tensor left by its own shift, i.e.
+    row i is tensor[i].roll(-shifts[i]), with a single gather. Scripted
+    so the fuser builds the index (arange + shift, mod s) in one
+    kernel."""
+
+    seq_length = tensor.size(1)
+    index = torch.arange(seq_length, device=tensor.device).unsqueeze(0) + \
+        shifts.to(tensor.device).unsqueeze(1)
+    return tensor.gather(1, torch.remainder(index, seq_length))
+
+
+def _gather_log_probs(logits, indices):
+    """Log probabilities of the indices, size [b, s] (or [b]), from
+    logits of size [b, s, v] (or [b, v]). cross_entropy still computes
+    a log_softmax over the vocabulary, but on the last dim: the reshape
+    is a view of contiguous logits, e.g. the prefill logits, where a
+    transposed input would be copied by the softmax kernel."""
+    return -F.cross_entropy(logits.reshape(-1, logits.size(-1)),
+                            indices.reshape(-1),
+                            reduction='none').view(indices.shape)
+
+
+# Attention mask and position ids of the longest sequence seen so far,
+# keyed on device. Neither depends on the token values, so shorter
+# sequences use a slice of them.
+_MASK_AND_POSITION_IDS_CACHE = {}
+
+
 def _build_attention_mask_and_position_ids(tokens):
     """Build the attention mask and postition ids for the input tokens."""
 
-    # Since we are not interested in loss-mask and reset attention/position
-    # is also False, eod_token is not used so it is safe to set it to None.
-    attention_mask, _, position_ids = get_ltor_masks_and_position_ids(
-        data=tokens,
-        eod_token=None,
-        reset_position_ids=False,
-        reset_attention_mask=False,
-        eod_mask_loss=False)
-
-    return attention_mask, position_ids
+    batch_size, seq_length = tokens.size()
+    cached = _MASK_AND_POSITION_IDS_CACHE.get(tokens.device)
+    if cached is None or cached[1].size(1) < seq_length:
+        # Since we are not interested in loss-mask and reset attention/position
+        # is also False, eod_token is not used so it is safe to set it to None.
+        attention_mask, _, position_ids = get_ltor_masks_and_position_ids(
+            data=tokens[:1],
+            eod_token=None,
+            reset_position_ids=False,
+            reset_attention_mask=False,
+            eod_mask_loss=False)
+        cached = (attention_mask, position_ids)
+        _MASK_AND_POSITION_IDS_CACHE[tokens.device] = cached
+
+    attention_mask, position_ids = cached
+    return attention_mask[..., :seq_length, :seq_length], \
+        position_ids[:, :seq_length].expand(batch_size, seq_length)
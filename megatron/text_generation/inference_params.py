@@ -1,10 +1,11 @@
+import math
 import torch
 import numpy as np
 import torch.nn.functional as F
 from typing import List
 
 from megatron import get_tokenizer, get_args
-from megatron.text_generation.sampling import sample
+from megatron.text_generation.sampling import sample, greedy_sample_with_log_probs
 from megatron.text_generation.communication import send_token_and_probs_to_first_pipeline_stage
 from megatron.core import mpu
 
@@ -20,6 +21,9 @@ class InferenceParams:
                  exit_layers=[]):
         self.max_sequence_length = max_sequence_length
         self.max_batch_size = max_batch_size
+        # Host side int on purpose: the attention layers use it as a
+        # slice bound into the KV cache, so a device tensor would need
+        # a sync per layer to be turned back into an index.
         self.sequence_len_offset = 0
         self.batch_size_offset = 0
         self.key_value_memory_dict = {}
@@ -41,6 +45,10 @@ class InferenceParams:
         self.prev_has_early_exited = False
         self.tokens = None
         self.probs = None
+        # Reused by the exit signal exchange with the first stage.
+        self.signal_buffer = None
+        # Tokens and log probs sent to the first stage in one message.
+        self.payload_buffer = None
 
     def clear_early_exit_states(self):
         self.has_early_exited = False
@@ -56,18 +64,15 @@ class InferenceParams:
         last_token_logits = logits[:, -1, :]
         log_probs = F.log_softmax(last_token_logits, dim=1)
         max_log_prob, token_id =  torch.max(log_probs[:, :], dim=1)
-        token = self.tokenizer.detokenize([int(token_id[-1])])
 
         # Old way to determine if I have early exited
         # self.has_early_exited = max_log_prob[-1] >= self.early_exit_thres
 
-        # For each max_log_prob, check if it is greater than early exit threshold
-        batch_size = len(max_log_prob)
-        exited_mask: List[int] = [0 for _ in range(batch_size)] # A list where item at index i = 1 iff request i in the batch wants to exit
-        for i in range(batch_size):
-            exited_mask[i] = 1 if max_log_prob[i] >= self.early_exit_thres else 0
-        
         if return_exited_mask:
+            # For each max_log_prob, check if it is greater than early exit threshold.
+            # A list where item at index i = 1 iff request i in the batch wants to exit,
+            # built with one device to host copy.
+            exited_mask: List[int] = (max_log_prob >= self.early_exit_thres).int().tolist()
             self.has_early_exited = any(exited_mask)
         else:
             self.has_early_exited = max_log_prob[-1] >= self.early_exit_thres
@@ -75,8 +80,9 @@ class InferenceParams:
         if self.print_max_probs:
             # print(f"layer [{layer_num}]: token [{token}], prob {float(torch.exp(max_log_prob[-1]))}")
             print(f"[InferenceParams: do_early_exit] layer [{layer_num}], has_early_exited: {self.has_early_exited}, threshold {self.early_exit_thres}. Printing below   token: raw prob - real prob(with exp)")
-            for i in range(len(max_log_prob)):
-                print(f"{self.tokenizer.detokenize([int(token_id[i])])}: {max_log_prob[i]} - {float(torch.exp(max_log_prob[i]))}")
+            # One device to host copy per tensor instead of one per element.
+            for token, log_prob in zip(token_id.tolist(), max_log_prob.tolist()):
+                print(f"{self.tokenizer.detokenize([token])}: {log_prob} - {math.exp(log_prob)}")
             print(f"[InferenceParams: do_early_exit] =====================================")
         if self.use_pipeline_inference and self.has_early_exited:
             if return_exited_mask:
@@ -91,6 +97,11 @@ class InferenceParams:
             return self.has_early_exited
 
     def get_tokens_and_probs(self, last_token_logits):
+        if self.top_k == 1 and self.top_p == 0.0:
+            # Greedy: the token and its log prob come from a single pass.
+            tokens, output_log_probs = greedy_sample_with_log_probs(
+                last_token_logits, vocab_size=self.tokenizer.vocab_size)
+            return tokens, output_log_probs.unsqueeze(1)
         tokens = sample(last_token_logits,
                             top_k=self.top_k,
                             top_p=self.top_p,
@@ -100,9 +111,11 @@ class InferenceParams:
             top_p = self.top_p * self.top_p_decay
             if self.top_p_bound > 0.0:
                 top_p = max(top_p, self.top_p_bound)
-        indices = torch.unsqueeze(tokens, 1)
-        log_probs = F.log_softmax(last_token_logits, dim=1)
-        output_log_probs = torch.gather(log_probs, 1, indices)
+        # log_softmax of the sampled tokens only, without the [b, v] result:
+        # log_softmax(x) = x - logsumexp(x).
+        output_log_probs = torch.take_along_dim(
+            last_token_logits, tokens.unsqueeze(1), dim=1) - \
+            torch.logsumexp(last_token_logits, dim=1, keepdim=True)
         return tokens, output_log_probs
 
     def send_to_first_pipeline_stage(self, tokens, probs):
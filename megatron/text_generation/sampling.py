@@ -7,8 +7,80 @@ Part of this code is inspired by:
 """
 
 
+from collections import OrderedDict
+
 import torch
 
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+
+if triton is not None:
+    @triton.jit
+    def _greedy_sample_kernel(logits_ptr, samples_ptr, log_probs_ptr,
+                              row_stride, vocab_size,
+                              BLOCK_SIZE: tl.constexpr):
+        """One program per row: running max, argmax and sum of exp over
+        the vocabulary in a single read of the logits."""
+        row = tl.program_id(0)
+        lanes = tl.arange(0, BLOCK_SIZE)
+        row_max = tl.full([BLOCK_SIZE], float('-inf'), tl.float32)
+        row_sum = tl.zeros([BLOCK_SIZE], dtype=tl.float32)
+        row_arg = tl.zeros([BLOCK_SIZE], dtype=tl.int32)
+        for start in range(0, vocab_size, BLOCK_SIZE):
+            offsets = start + lanes
+            x = tl.load(logits_ptr + row * row_stride + offsets,
+                        mask=offsets < vocab_size,
+                        other=float('-inf')).to(tl.float32)
+            new_max = tl.maximum(row_max, x)
+            # Lanes that have only seen -inf keep a zero sum.
+            safe_max = tl.where(new_max == float('-inf'), 0.0, new_max)
+            row_sum = row_sum * tl.exp(row_max - safe_max) + \
+                tl.exp(x - safe_max)
+            row_arg = tl.where(x > row_max, offsets, row_arg)
+            row_max = new_max
+        max_logit = tl.max(row_max, 0)
+        total = tl.sum(row_sum * tl.exp(row_max - max_logit), 0)
+        # Lowest index among the maxima, as torch.argmax.
+        sample = tl.min(tl.where(row_max == max_logit, row_arg, vocab_size), 0)
+        tl.store(samples_ptr + row, sample.to(tl.int64))
+        # log_softmax of the max: max - (max + log(total)).
+        tl.store(log_probs_ptr + row, -tl.log(total))
+
+
+
+def greedy_sample_with_log_probs(logits, vocab_size=None):
+    """Greedy sample and its log probability.
+    Note: logits has the dimension [b, v]. With triton available this is
+          a single pass over the logits instead of separate softmax,
+          max and argmax kernels.
+    """
+
+    assert logits.ndim == 2, 'expected the logits to be of [b, v] shape.'
+
+    if triton is not None and logits.is_cuda:
+        logits = logits.contiguous()
+        batch_size, logits_size = logits.size()
+        samples = torch.empty(batch_size, dtype=torch.int64,
+                              device=logits.device)
+        log_probs = torch.empty(batch_size, dtype=torch.float32,
+                                device=logits.device)
+        block_size = min(triton.next_power_of_2(logits_size), 4096)
+        _greedy_sample_kernel[(batch_size,)](logits, samples, log_probs,
+                                             logits.stride(0), logits_size,
+                                             BLOCK_SIZE=block_size)
+    else:
+        max_logits, samples = torch.max(logits, dim=-1)
+        log_probs = max_logits.float() - torch.logsumexp(logits.float(), dim=-1)
+
+    if vocab_size:
+        samples = torch.clamp(samples, min=0, max=(vocab_size - 1))
+
+    return samples, log_probs
+
 
 
 def modify_logits_for_top_k_filtering(logits, top_k):
@@ -91,3 +163,101 @@ def sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
         samples = torch.clamp(samples, min=0, max=(vocab_size - 1))
 
     return samples
+
+
+
+def _sample_in_graph(logits, top_k, top_p, vocab_size):
+    """Body of sample() captured by graphed_sample. logits are already
+    scaled by the temperature and may be modified in place, and top_p
+    is a 0-d tensor (or None) so that its value is read at replay."""
+
+    if top_k > 1:
+        modify_logits_for_top_k_filtering(logits, top_k)
+    elif top_p is not None:
+        modify_logits_for_top_p_filtering(logits, top_p)
+    probs = logits.softmax(dim=-1)
+    # torch.multinomial checks the probabilities on the host, which is
+    # not allowed during capture. argmax(p / E) with E ~ Exp(1) draws
+    # from the same distribution without a sync.
+    samples = probs.div_(torch.empty_like(probs).exponential_()).argmax(dim=-1)
+    if vocab_size:
+        samples = torch.clamp(samples, min=0, max=(vocab_size - 1))
+    return samples
+
+
+
+# CUDA graphs of _sample_in_graph(), least recently used first. Each
+# graph holds a private memory pool, so only a few are kept. The key
+# only has what changes the captured kernels: the temperature and the
+# top-p value are inputs of the graph.
+_SAMPLE_GRAPHS = OrderedDict()
+_SAMPLE_GRAPHS_MAX_SIZE = 4
+
+
+def graphed_sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
+    """Same as sample() but replayed from a CUDA graph captured on the
+    first call for this shape, so the filtering, softmax and
+    sampling kernels are launched at once. The parameters must stay
+    fixed for the whole generation, i.e. no top-p decay.
+    """
+
+    # Same checks as sample(), done on the host before the replay.
+    assert logits.ndim == 2, 'expected the logits to be of [b, v] shape.'
+    assert logits.type() == 'torch.cuda.FloatTensor', \
+        'input logits should be floats.'
+    if top_k == 1:
+        return sample(logits, top_k=top_k, top_p=top_p,
+                      temperature=temperature, vocab_size=vocab_size)
+    if top_k > 1:
+        assert top_p == 0.0, 'cannot set both top-k and top-p samplings.'
+        assert top_k <= logits.size(1), 'top-k is larger than logit size.'
+        if vocab_size:
+            assert top_k < vocab_size, 'top-k is larger than vocab size.'
+    elif top_p > 0.0:
+        assert top_p <= 1.0, 'top-p should be in (0, 1].'
+
+    key = (tuple(logits.size()), logits.device, top_k, top_p > 0.0,
+           vocab_size)
+    entry = _SAMPLE_GRAPHS.get(key)
+    if entry is None:
+        static_logits = torch.empty_like(logits)
+        static_top_p = None
+        if top_p > 0.0:
+            static_top_p = torch.empty((), dtype=logits.dtype,
+                                       device=logits.device)
+        # Warm up on a side stream before capturing, as required by
+        # torch.cuda.graph. The warm up draws from the generator, fork
+        # it so that a seeded generation samples the same tokens
+        # whether or not the graph was already captured.
+        with torch.random.fork_rng(devices=[logits.device]):
+            static_logits.copy_(logits)
+            if static_top_p is not None:
+                static_top_p.fill_(top_p)
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    _sample_in_graph(static_logits, top_k, static_top_p,
+                                     vocab_size)
+            torch.cuda.current_stream().wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_samples = _sample_in_graph(static_logits, top_k,
+                                              static_top_p, vocab_size)
+        entry = (graph, static_logits, static_top_p, static_samples)
+        _SAMPLE_GRAPHS[key] = entry
+        if len(_SAMPLE_GRAPHS) > _SAMPLE_GRAPHS_MAX_SIZE:
+            _SAMPLE_GRAPHS.popitem(last=False)
+    else:
+        _SAMPLE_GRAPHS.move_to_end(key)
+
+    graph, static_logits, static_top_p, static_samples = entry
+    if temperature != 1.0:
+        torch.div(logits, temperature, out=static_logits)
+    else:
+        static_logits.copy_(logits)
+    if static_top_p is not None:
+        static_top_p.fill_(top_p)
+    graph.replay()
+    # The static output is overwritten by the next replay.
+    return static_samples.clone()
@@ -52,8 +52,10 @@ def detokenize_generations(tokens_gpu_tensor,
 
 
 def tokenize_prompts(prompts=None, tokens_to_generate=None,
-                     add_BOS=None, rank=0):
-    """Tokenize prompts and make them avaiable on all ranks."""
+                     add_BOS=None, rank=0, return_min_prompt_length=False):
+    """Tokenize prompts and make them avaiable on all ranks.
+    If return_min_prompt_length is True, the shortest prompt length is
+    also returned as a python int, broadcast along with the sizes."""
 
     # On all ranks set to None so we can pass them to functions
     sizes_list = None
@@ -65,24 +67,30 @@ def tokenize_prompts(prompts=None, tokens_to_generate=None,
         assert prompts is not None
         assert tokens_to_generate is not None
         # Tensor of tokens padded and their unpadded length.
-        prompts_tokens_cuda_long_tensor, prompts_length_cuda_long_tensor = \
-            _tokenize_prompts_and_batch(prompts, tokens_to_generate, add_BOS)
+        prompts_tokens_cuda_long_tensor, prompts_length_cuda_long_tensor, \
+            min_prompt_length = _tokenize_prompts_and_batch(
+                prompts, tokens_to_generate, add_BOS)
         # We need the sizes of these tensors for the boradcast
         sizes_list = [prompts_tokens_cuda_long_tensor.size(0), # Batch size
-                      prompts_tokens_cuda_long_tensor.size(1)] # Sequence lenght
+                      prompts_tokens_cuda_long_tensor.size(1), # Sequence lenght
+                      min_prompt_length]
 
     # First, broadcast the sizes.
-    sizes_tensor = broadcast_int_list(2, int_list=sizes_list, rank=rank)
+    sizes_tensor = broadcast_int_list(3, int_list=sizes_list, rank=rank)
 
     # Now that we have the sizes, we can boradcast the tokens
     # and length tensors.
     sizes = sizes_tensor.tolist()
+    min_prompt_length = sizes.pop()
     prompts_tokens_cuda_long_tensor = broadcast_tensor(
         sizes, torch.int64, tensor=prompts_tokens_cuda_long_tensor, rank=rank)
     prompts_length_cuda_long_tensor = broadcast_tensor(
         sizes[0], torch.int64, tensor=prompts_length_cuda_long_tensor,
         rank=rank)
 
+    if return_min_prompt_length:
+        return prompts_tokens_cuda_long_tensor, \
+            prompts_length_cuda_long_tensor, min_prompt_length
     return prompts_tokens_cuda_long_tensor, prompts_length_cuda_long_tensor
 
 
@@ -122,4 +130,4 @@ def _tokenize_prompts_and_batch(prompts, tokens_to_generate, add_BOS):
     prompts_tokens_tensor = torch.cuda.LongTensor(prompts_tokens)
     prompts_length_tensor = torch.cuda.LongTensor(prompts_length)
 
-    return prompts_tokens_tensor, prompts_length_tensor
+    return prompts_tokens_tensor, prompts_length_tensor, min(prompts_length)
@@ -0,0 +1,133 @@
+import pytest
+import torch
+
+from megatron.text_generation import generation
+from megatron.text_generation.generation import (
+    _early_stop_update,
+    _gather_log_probs,
+    _roll_rows_left,
+    _special_token_id,
+    _special_token_ids,
+    _write_started_rows,
+)
+
+
+def test_roll_rows_left():
+    tensor = torch.arange(24).view(4, 6)
+    shifts = torch.tensor([0, 1, 5, 3])
+    expected = torch.stack([row.roll(-int(shift)) for row, shift in zip(tensor, shifts)])
+    assert torch.equal(_roll_rows_left(tensor, shifts), expected)
+
+
+def test_roll_rows_left_float():
+    torch.manual_seed(0)
+    tensor = torch.randn(3, 9)
+    shifts = torch.tensor([8, 2, 0])
+    expected = torch.stack([row.roll(-int(shift)) for row, shift in zip(tensor, shifts)])
+    assert torch.equal(_roll_rows_left(tensor, shifts), expected)
+
+
+def test_write_started_rows():
+    tokens = torch.arange(20).view(4, 5)
+    new_sample = torch.tensor([100, 101, 102, 103])
+    started = torch.tensor([True, False, True, False])
+    expected = tokens.clone()
+    expected[started, 3] = new_sample[started]
+    # Writes through the column view into tokens.
+    _write_started_rows(tokens[:, 3], new_sample, started)
+    assert torch.equal(tokens, expected)
+
+
+def test_write_started_rows_float():
+    log_probs = torch.zeros(3, 4)
+    new_log_probs = torch.tensor([-0.5, -1.5, -2.5])
+    started = torch.tensor([False, True, True])
+    _write_started_rows(log_probs[:, 2], new_log_probs, started)
+    assert torch.equal(log_probs[:, 2], torch.tensor([0.0, -1.5, -2.5]))
+    assert torch.count_nonzero(log_probs[:, [0, 1, 3]]) == 0
+
+
+def test_gather_log_probs():
+    torch.manual_seed(0)
+    logits = torch.randn(2, 6, 11)
+    tokens = torch.randint(0, 11, (2, 6))
+    # Non-contiguous slice, as in score_and_return_on_first_stage.
+    expected = torch.log_softmax(logits[:, :-1], dim=2).gather(
+        2, tokens[:, 1:].unsqueeze(2)).squeeze(2)
+    assert torch.allclose(_gather_log_probs(logits[:, :-1, :], tokens[:, 1:]), expected)
+    # [b, v] logits of a decode step.
+    expected = torch.log_softmax(logits[:, -1], dim=1).gather(
+        1, tokens[:, -1:]).squeeze(1)
+    assert torch.allclose(_gather_log_probs(logits[:, -1, :], tokens[:, -1]), expected)
+
+
+class _SentencePieceLikeTokenizer:
+    """Prepends BOS and a dummy-prefix piece, no merged double newline."""
+
+    def tokenize(self, text):
+        ids = [1]
+        if text.startswith('a'):
+            ids.append(5)  # '▁a'
+            text = text[1:]
+        else:
+            ids.append(3)  # '▁'
+        return ids + [{':': 6, '\n': 7}[c] for c in text]
+
+
+class _BPELikeTokenizer:
+    """No prefix, merged double newline."""
+
+    def tokenize(self, text):
+        ids = []
+        for piece in text.replace('\n\n', '|').replace('a', '#'):
+            ids.append({'#': 64, ':': 25, '\n': 198, '|': 628}[piece])
+        return ids
+
+
+@pytest.fixture
+def tokenizer(monkeypatch, request):
+    monkeypatch.setattr(generation, 'get_tokenizer', lambda: request.param)
+    _special_token_ids.cache_clear()
+    yield request.param
+    _special_token_ids.cache_clear()
+
+
+@pytest.mark.parametrize('tokenizer', [_SentencePieceLikeTokenizer()], indirect=True)
+def test_special_token_ids_skip_prefix(tokenizer):
+    assert _special_token_id(':') == 6
+    assert _special_token_id('\n') == 7
+    assert _special_token_ids('\n\n') == (7, 7)
+    with pytest.raises(AssertionError):
+        _special_token_id('\n\n')
+
+
+@pytest.mark.parametrize('tokenizer', [_BPELikeTokenizer()], indirect=True)
+def test_special_token_ids_merged(tokenizer):
+    assert _special_token_id(':') == 25
+    assert _special_token_id('\n') == 198
+    assert _special_token_id('\n\n') == 628
+
+
+def _stop(new_sample, previous, mode):
+    batch_size = len(new_sample)
+    tokens = torch.zeros(batch_size, 4, dtype=torch.int64)
+    tokens[:, 1] = torch.tensor(previous)
+    is_generation_done = torch.zeros(batch_size, dtype=torch.uint8)
+    lengths = torch.full((batch_size,), 4, dtype=torch.int64)
+    done = _early_stop_update(torch.tensor(new_sample), tokens, 2, None, None,
+                              torch.ones(batch_size, dtype=torch.bool),
+                              is_generation_done, lengths, mode)
+    return done.tolist(), lengths.tolist()
+
+
+@pytest.mark.parametrize('tokenizer', [_SentencePieceLikeTokenizer()], indirect=True)
+def test_early_stop_eol_without_merged_double_newline(tokenizer):
+    # The dummy-prefix piece (3) never ends the generation.
+    assert _stop([7, 3, 6], [0, 0, 0], 'eol') == ([1, 0, 0], [3, 4, 4])
+    assert _stop([7, 7, 3], [7, 0, 7], 'double_eol') == ([1, 0, 0], [3, 4, 4])
+
+
+@pytest.mark.parametrize('tokenizer', [_BPELikeTokenizer()], indirect=True)
+def test_early_stop_eol_with_merged_double_newline(tokenizer):
+    assert _stop([198, 628, 25], [0, 0, 0], 'eol') == ([1, 1, 0], [3, 3, 4])
+    assert _stop([198, 198, 628], [198, 0, 0], 'double_eol') == ([1, 0, 1], [3, 4, 3])
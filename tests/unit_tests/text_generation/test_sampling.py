@@ -0,0 +1,111 @@
+import pytest
+import torch
+
+from megatron.text_generation import sampling
+from megatron.text_generation.sampling import greedy_sample_with_log_probs
+
+
+def _reference_greedy(logits, vocab_size=None):
+    samples = torch.argmax(logits, dim=-1)
+    if vocab_size:
+        samples = torch.clamp(samples, min=0, max=(vocab_size - 1))
+    log_probs = torch.log_softmax(logits.float(), dim=-1).gather(
+        1, torch.argmax(logits, dim=-1, keepdim=True)).squeeze(1)
+    return samples, log_probs
+
+
+def _check_greedy(logits, vocab_size=None):
+    samples, log_probs = greedy_sample_with_log_probs(logits, vocab_size=vocab_size)
+    expected_samples, expected_log_probs = _reference_greedy(logits, vocab_size=vocab_size)
+    assert torch.equal(samples, expected_samples)
+    assert torch.allclose(log_probs, expected_log_probs, atol=1e-5, rtol=1e-5)
+
+
+def test_greedy_sample_with_log_probs_fallback():
+    torch.manual_seed(0)
+    _check_greedy(torch.randn(4, 1000))
+
+
+needs_triton = pytest.mark.skipif(
+    not torch.cuda.is_available() or sampling.triton is None,
+    reason="CUDA and triton required")
+
+
+@needs_triton
+@pytest.mark.parametrize("vocab", [7, 1000, 4096, 4097, 50257])
+def test_greedy_sample_kernel_matches_torch(vocab):
+    # Sizes that are not a multiple of the block leave masked lanes in
+    # the last block.
+    torch.manual_seed(0)
+    _check_greedy(torch.randn(5, vocab, device='cuda'))
+
+
+@needs_triton
+def test_greedy_sample_kernel_ties():
+    # torch.argmax returns the lowest index among equal maxima, also
+    # when they are in different blocks or lanes.
+    logits = torch.randn(3, 10000, device='cuda')
+    logits[0, [3, 7]] = 100.0
+    logits[1, [904, 904 + 4096, 9999]] = 100.0
+    logits[2, :] = 1.0
+    _check_greedy(logits)
+
+
+@needs_triton
+def test_greedy_sample_kernel_inf_lanes():
+    logits = torch.randn(3, 10000, device='cuda')
+    # Scattered -inf, e.g. from top-k filtering.
+    logits[0, ::3] = float('-inf')
+    # A whole block of -inf before the maximum.
+    logits[1, :4096] = float('-inf')
+    # Everything but one token is -inf.
+    logits[2, :] = float('-inf')
+    logits[2, 8191] = 0.0
+    _check_greedy(logits)
+
+
+@needs_triton
+def test_greedy_sample_kernel_strided_and_clamped():
+    # Row-strided input and samples clamped to the vocab size.
+    logits = torch.randn(4, 1200, device='cuda')[:, :1100]
+    logits[:, 1050] = 100.0
+    _check_greedy(logits, vocab_size=1000)
+
+
+needs_cuda = pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA not available")
+
+
+@needs_cuda
+def test_graphed_sample_cache_is_bounded():
+    sampling._SAMPLE_GRAPHS.clear()
+    for batch_size in range(1, sampling._SAMPLE_GRAPHS_MAX_SIZE + 3):
+        logits = torch.randn(batch_size, 100, device='cuda')
+        for temperature in (0.5, 1.0, 2.0):
+            sampling.graphed_sample(logits, top_p=0.9, temperature=temperature)
+    assert len(sampling._SAMPLE_GRAPHS) == sampling._SAMPLE_GRAPHS_MAX_SIZE
+    sampling._SAMPLE_GRAPHS.clear()
+
+
+@needs_cuda
+def test_graphed_sample_same_tokens_on_miss_and_hit():
+    sampling._SAMPLE_GRAPHS.clear()
+    logits = torch.randn(4, 1000, device='cuda')
+    samples = []
+    # The first call captures the graph, the second replays it.
+    for _ in range(2):
+        torch.manual_seed(1234)
+        samples.append(torch.stack([
+            sampling.graphed_sample(logits, top_k=50, temperature=0.7)
+            for _ in range(8)]))
+    assert torch.equal(samples[0], samples[1])
+    sampling._SAMPLE_GRAPHS.clear()
+
+
+def test_sample_in_graph_matches_distribution():
+    # The sync free draw used inside the graph follows softmax(logits).
+    torch.manual_seed(0)
+    probs = torch.tensor([0.5, 0.3, 0.15, 0.05])
+    logits = probs.log().repeat(20000, 1)
+    samples = sampling._sample_in_graph(logits, 0, None, None)
+    frequencies = torch.bincount(samples, minlength=4).float() / samples.numel()
+    assert torch.allclose(frequencies, probs, atol=0.02)
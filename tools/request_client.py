@@ -1,15 +1,60 @@
+import io
 import requests
 import json
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 URL = "http://localhost:5000/api"
 HEADER = {
     "Content-Type": "application/json; charset=UTF-8",
 }
 BATCH_SIZE = 2
+# Number of batches in flight at once. The server serializes generation,
+# so with more than one the printed latency also counts the time a batch
+# waits behind the others, not only its own generation time.
+CONCURRENCY = 1
 SEED = 42
 PROMPTS_FILE = "tools/prompt_lmsys_chat_4.jsonl"
 
+# Keep-alive session so all batches reuse the same connection. It is
+# shared by the CONCURRENCY worker threads, each request only reads it
+# and the adapter pool hands every thread its own connection.
+SESSION = requests.Session()
+SESSION.headers.update(HEADER)
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=CONCURRENCY))
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=CONCURRENCY))
+
+
+def dumps(data):
+    """Serialize a request body, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode("utf-8")
+
+
+def loads(content):
+    """Parse a response body, with orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(content)
+
+
+def submit(data):
+    """Send one request, return the response and its latency."""
+    start_time = time.time()
+    response = SESSION.put(URL, data=dumps(data))
+    return response, time.time() - start_time
+
 
 def request(
     prompts,
@@ -21,7 +66,7 @@ def request(
 ):
     length = len(prompts)
     if BATCH_SIZE > 1:
-        batch_prompts = []
+        batches = []
         print("Batching requests with batch size:", BATCH_SIZE)
         for i in range(0, length, BATCH_SIZE):
             batch_prompts = prompts[i : i + BATCH_SIZE]
@@ -38,26 +83,40 @@ def request(
                 "echo_prompts": False,
                 "early_exit_thres": early_exit_thres,
                 "exit_layers": exit_layers,
+                # Index of the first prompt, the server numbers the rest.
                 "prompt_idx": i
             }
             if use_early_exit:
                 data["use_early_exit"] = True
             if print_max_prob:
                 data["print_max_prob"] = True
-            start_time = time.time()
-            response = requests.put(URL, headers=HEADER, data=json.dumps(data))
-            end_time = time.time()
-            print("Request:-------------------------------------------------")
-            for i in range(len(batch_prompts)):
-                print(f"{batch_prompts[i]}")
-                print(
-                    f"Response:------------------({end_time - start_time:.4f}s)-------------------"
-                )
+            batches.append((batch_prompts, data))
+
+        # Send all batches, print the responses in the original order.
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+            futures = [executor.submit(submit, data) for _, data in batches]
+            for (batch_prompts, _), future in zip(batches, futures):
+                response, latency = future.result()
+                # Parse the body once for the whole batch.
                 try:
-                    print(f'{response.json()["text"][i]}')
+                    texts = loads(response.content)["text"]
                 except Exception as e:
-                    print(response)
-                print("----------------------------------------------------------")
+                    texts = None
+                # Write the whole batch at once, outside of the timed request.
+                buf = io.StringIO()
+                print("Request:-------------------------------------------------", file=buf)
+                for j in range(len(batch_prompts)):
+                    print(f"{batch_prompts[j]}", file=buf)
+                    print(
+                        f"Response:------------------({latency:.4f}s)-------------------",
+                        file=buf,
+                    )
+                    try:
+                        print(f'{texts[j]}', file=buf)
+                    except Exception as e:
+                        print(response, file=buf)
+                    print("----------------------------------------------------------", file=buf)
+                sys.stdout.write(buf.getvalue())
 
 
     else:
@@ -71,33 +130,34 @@ def request(
                 "echo_prompts": False,
                 "early_exit_thres": early_exit_thres,
                 "exit_layers": exit_layers,
+                "prompt_idx": i
             }
             if use_early_exit:
                 data["use_early_exit"] = True
             if print_max_prob:
                 data["print_max_prob"] = True
-            start_time = time.time()
-            response = requests.put(URL, headers=HEADER, data=json.dumps(data))
-            end_time = time.time()
-            print("Request:-------------------------------------------------")
-            print(f"{prompts[i]}")
+            response, latency = submit(data)
+            buf = io.StringIO()
+            print("Request:-------------------------------------------------", file=buf)
+            print(f"{prompts[i]}", file=buf)
             print(
-                f"Response:------------------({end_time - start_time:.4f}s)-------------------"
+                f"Response:------------------({latency:.4f}s)-------------------",
+                file=buf,
             )
             try:
-                print(f'{response.json()["text"][0]}')
+                print(f'{loads(response.content)["text"][0]}', file=buf)
             except Exception as e:
-                print(response)
-            print("----------------------------------------------------------")
+                print(response, file=buf)
+            print("----------------------------------------------------------", file=buf)
+            sys.stdout.write(buf.getvalue())
 
 
 def main(
     file_name, tokens_to_generate, use_early_exit, early_exit_thres, print_max_prob, exit_layers
 ):
-    prompts = []
-    with open(file_name, "r") as f:
-        for line in f.readlines():
-            prompts.append(json.loads(line)["text"])
+    # Binary lines go straight to orjson, without building a list of lines.
+    with open(file_name, "rb") as f:
+        prompts = [loads(line)["text"] for line in f]
     request(
         prompts, tokens_to_generate, use_early_exit, early_exit_thres, print_max_prob, exit_layers
     )